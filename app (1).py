@@ -1,19 +1,51 @@
 import asyncio
 
-import requests
+import httpx
 
 import re
 
-import phonenumbers
-
-from phonenumbers import geocoder
-
 from telegram import Bot, InlineKeyboardButton, InlineKeyboardMarkup, Update
 
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+
 import json
 
 import os
 
+import signal
+
+import sqlite3
+
+import threading
+
+import hashlib
+
+import heapq
+
+import functools
+
+import argparse
+
+import concurrent.futures
+
+import multiprocessing
+
+import html
+
+import math
+
+import random
+
+import time
+
+from collections import OrderedDict, deque
+
+from urllib.parse import urlsplit
+
+STARTED_AT = time.perf_counter()
+
+STARTUP_TIMINGS = {}
+
 BOT_TOKEN = "sex:sex-sex-sex-sex"
 
 bot = Bot(token=BOT_TOKEN)
@@ -22,6 +54,24 @@ GROUP_IDS = [-sec]
 
 OTP_FILE = "otp_store.json"
 
+OTP_DB_FILE = "otp_store.db"
+
+OTP_SNAPSHOT_FILE = "otp_store.snapshot.db"
+
+OTP_FLUSH_BATCH = 500
+
+OTP_FLUSH_INTERVAL = 2
+
+OTP_SNAPSHOT_INTERVAL = 15 * 60
+
+OTP_TTL = 0
+
+OTP_TTL_BY_SERVICE = {}
+
+OTP_COMPACT_INTERVAL = 30
+
+OTP_COMPACT_CHUNK = 500
+
 # ============================
 
 # API PANELS
@@ -36,7 +86,9 @@ API_PANELS = {
 
         "token": "sex=",
 
-        "records": 20
+        "records": 20,
+
+        "timeout": 10
 
     },
 
@@ -46,12 +98,22 @@ API_PANELS = {
 
         "token": "sex",
 
-        "records": 20
+        "records": 20,
+
+        "timeout": 10
 
     }
 
 }
 
+PANEL_TIMEOUT = 10
+
+PANEL_MAX_CONNECTIONS = 10
+
+PANEL_KEEPALIVE_EXPIRY = 30
+
+PANEL_BACKFILL_ON_START = 1
+
 # ============================
 
 # CLI FILTER SETTINGS
@@ -64,409 +126,4457 @@ BLOCKED_CLIS = []
 
 CLI_FILTER_MODE = "off"
 
-def cli_passes_filter(cli):
+CLI_FILTER_CACHE_SIZE = 10000
 
-    cli_lower = cli.lower()
+class AhoCorasick:
 
-    if CLI_FILTER_MODE == "allow":
+    def __init__(self, patterns):
 
-        return any(a.lower() in cli_lower for a in ALLOWED_CLIS)
+        self.goto = [{}]
 
-    elif CLI_FILTER_MODE == "block":
+        self.fail = [0]
 
-        return not any(b.lower() in cli_lower for b in BLOCKED_CLIS)
+        self.out = [False]
 
-    return True
+        self.match_all = False
 
-# ============================
+        for pattern in patterns:
 
-# OTP STORAGE
+            if not pattern:
 
-# ============================
+                self.match_all = True
 
-def load_otp_store():
+                continue
 
-    if not os.path.exists(OTP_FILE):
+            state = 0
 
-        return {}
+            for ch in pattern:
 
-    with open(OTP_FILE, "r") as f:
+                nxt = self.goto[state].get(ch)
 
-        return json.load(f)
+                if nxt is None:
 
-def save_otp_store(data):
+                    nxt = len(self.goto)
 
-    with open(OTP_FILE, "w") as f:
+                    self.goto[state][ch] = nxt
 
-        json.dump(data, f, indent=2)
+                    self.goto.append({})
 
-# ============================
+                    self.fail.append(0)
 
-# FETCH FUNCTIONS
+                    self.out.append(False)
 
-# ============================
+                state = nxt
 
-def fetch_latest(panel):
+            self.out[state] = True
 
-    cfg = API_PANELS[panel]
+        queue = deque(self.goto[0].values())
 
-    try:
+        while queue:
 
-        response = requests.get(cfg["url"], params={
+            state = queue.popleft()
 
-            "token": cfg["token"],
+            for ch, nxt in self.goto[state].items():
 
-            "records": cfg["records"]
+                queue.append(nxt)
 
-        }, timeout=10)
+                fallback = self.fail[state]
 
-        data = response.json()
+                while fallback and ch not in self.goto[fallback]:
 
-        if data.get("status") != "success":
+                    fallback = self.fail[fallback]
 
-            print(f"{panel.upper()} API Error:", data)
+                self.fail[nxt] = self.goto[fallback].get(ch, 0)
 
-            return None
+                self.out[nxt] = self.out[nxt] or self.out[self.fail[nxt]]
 
-        records = data.get("data", [])
+    def search(self, text):
 
-        if not records:
+        if self.match_all:
 
-            return None
+            return True
+
+        goto, fail, out = self.goto, self.fail, self.out
+
+        state = 0
+
+        for ch in text:
+
+            while state and ch not in goto[state]:
+
+                state = fail[state]
+
+            state = goto[state].get(ch, 0)
+
+            if out[state]:
+
+                return True
+
+        return False
+
+class CliFilter:
+
+    def __init__(self, mode, allowed, blocked):
+
+        self.mode = mode
+
+        patterns = allowed if mode == "allow" else blocked if mode == "block" else []
 
-        latest = records[0]
+        self.patterns = len(patterns)
+
+        self.matcher = AhoCorasick(p.lower() for p in patterns)
+
+        self.cache = OrderedDict()
+
+        self.hits = 0
+
+        self.misses = 0
+
+    def passes(self, cli):
+
+        decision = self.cache.get(cli)
+
+        if decision is not None:
+
+            self.cache.move_to_end(cli)
+
+            self.hits += 1
+
+            return decision
+
+        self.misses += 1
+
+        if self.mode == "allow":
+
+            decision = self.matcher.search(cli.lower())
+
+        elif self.mode == "block":
+
+            decision = not self.matcher.search(cli.lower())
+
+        else:
+
+            decision = True
+
+        self.cache[cli] = decision
+
+        if len(self.cache) > CLI_FILTER_CACHE_SIZE:
+
+            self.cache.popitem(last=False)
+
+        return decision
+
+    def stats(self):
 
         return {
 
-            "time": latest.get("dt", ""),
+            "mode": self.mode,
+
+            "patterns": self.patterns,
 
-            "number": latest.get("num", ""),
+            "cached": len(self.cache),
 
-            "service": latest.get("cli", ""),
+            "hits": self.hits,
 
-            "message": latest.get("message", "")
+            "misses": self.misses
 
         }
 
-    except Exception as e:
+CLI_FILTER = None
 
-        print(f"{panel.upper()} Fetch Error:", e)
+def compile_cli_filter():
 
-        return None
+    global CLI_FILTER
+
+    CLI_FILTER = CliFilter(CLI_FILTER_MODE, ALLOWED_CLIS, BLOCKED_CLIS)
+
+# Changing ALLOWED_CLIS / BLOCKED_CLIS / CLI_FILTER_MODE must go through here (or apply_config) so the automaton is rebuilt.
+
+def set_cli_filter(mode=None, allowed=None, blocked=None):
+
+    global CLI_FILTER_MODE, ALLOWED_CLIS, BLOCKED_CLIS
+
+    if mode is not None:
+
+        CLI_FILTER_MODE = mode
+
+    if allowed is not None:
+
+        ALLOWED_CLIS = list(allowed)
+
+    if blocked is not None:
+
+        BLOCKED_CLIS = list(blocked)
+
+    compile_cli_filter()
+
+compile_cli_filter()
+
+def cli_passes_filter(cli):
+
+    return CLI_FILTER.passes(cli)
 
 # ============================
 
-# HELPERS
+# GROUP ROUTING
 
 # ============================
 
-def extract_otp(message):
+# Groups without an entry here get every record. Each key narrows a group to
 
-    for pat in [r'\d{6}', r'\d{4}', r'\d{3}-\d{3}']:
+# matching records, e.g. {"services": ["whatsapp"], "countries": ["+91"], "panels": ["cr"]}.
 
-        match = re.search(pat, message)
+GROUP_ROUTES = {}
 
-        if match:
+def normalize_service(service):
 
-            return match.group(0)
+    return service.strip().lower()
 
-    return None
+def normalize_prefix(prefix):
 
-def mask_number(number_str):
+    return str(prefix).lstrip("+").strip()
 
-    try:
+class RoutingIndex:
 
-        number_str = f"+{number_str}"
+    def __init__(self, groups, routes):
 
-        length = len(number_str)
+        self.groups = list(dict.fromkeys(list(groups) + list(routes)))
 
-        show_first = 5 if length >= 10 else 4
+        self.by_service = {}
 
-        show_last = 4 if length >= 10 else 2
+        self.by_country = {}
 
-        stars = "*" * (length - show_first - show_last)
+        self.by_panel = {}
 
-        return f"{number_str[:show_first]}{stars}{number_str[-show_last:]}"
+        self.service_any = 0
 
-    except:
+        self.country_any = 0
 
-        return f"+{number_str}"
+        self.panel_any = 0
 
-def get_country_info(number_str):
+        for bit, gid in enumerate(self.groups):
 
-    try:
+            mask = 1 << bit
 
-        if not number_str.startswith("+"):
+            route = routes.get(gid) or {}
 
-            number_str = "+" + number_str
+            self.service_any |= self._index(self.by_service, route.get("services"), mask, normalize_service)
 
-        parsed = phonenumbers.parse(number_str)
+            self.country_any |= self._index(self.by_country, route.get("countries"), mask, normalize_prefix)
 
-        country_name = geocoder.description_for_number(parsed, "en")
+            self.panel_any |= self._index(self.by_panel, route.get("panels"), mask, str)
 
-        region = phonenumbers.region_code_for_number(parsed)
+        self.prefix_lengths = sorted({len(prefix) for prefix in self.by_country})
 
-        if region:
+        self.routed = 0
 
-            base = 127462 - ord("A")
+        self.unrouted = 0
 
-            flag = chr(base + ord(region[0])) + chr(base + ord(region[1]))
+    @staticmethod
 
-        else:
+    def _index(table, values, mask, normalize):
 
-            flag = "🌍"
+        if not values:
 
-        return country_name or "Unknown", flag
+            return mask
 
-    except:
+        for value in values:
 
-        return "Unknown", "🌍"
+            key = normalize(value)
 
-def format_message(record):
+            table[key] = table.get(key, 0) | mask
 
-    raw = record["message"]
+        return 0
 
-    otp = extract_otp(raw)
+    def route(self, panel, record):
 
-    clean = raw.replace("<", "&lt;").replace(">", "&gt;")
+        mask = self.service_any | self.by_service.get(normalize_service(record["service"]), 0)
 
-    country, flag = get_country_info(record["number"])
+        mask &= self.panel_any | self.by_panel.get(panel, 0)
 
-    masked = mask_number(record["number"])
+        if mask & ~self.country_any:
 
-    return f"""
+            number = record["number"].lstrip("+")
 
-<b>{flag} New {record['service']} OTP!</b>
-<blockquote>🕐 Time: {record['time']}</blockquote>
-<blockquote>{flag} Country: {country}</blockquote>
-<blockquote>📊 Service: {record['service']}</blockquote>
-<blockquote>🔢 Number: {masked}</blockquote>
-<blockquote>💠 OTP: <code>{otp}</code></blockquote>
-<blockquote>📝 Full Message:</blockquote>
-<pre>{clean}</pre>
-Powered by ❤️ <b> Prime OTP </b> ❤️ 
-Support 👥 <strong>  </strong> 👥
+            country = self.country_any
 
-"""
+            for length in self.prefix_lengths:
 
-async def send_to_all_groups(msg):
+                country |= self.by_country.get(number[:length], 0)
 
-    keyboard = InlineKeyboardMarkup([
+            mask &= country
 
-        [
+        chats = []
 
-            InlineKeyboardButton("🧮 Numbers", url="https://t.me/sex"),
+        while mask:
 
-            InlineKeyboardButton("💌 Discussion", url="https://t.me/sex")
+            low = mask & -mask
 
-        ],
+            chats.append(self.groups[low.bit_length() - 1])
 
-        [
+            mask ^= low
 
-            InlineKeyboardButton("👨‍💻 Developer", url="https://t.me/sex"),
+        if chats:
 
-            InlineKeyboardButton("✅ OTP", url="https://t.me/sex")
+            self.routed += 1
 
-        ]
+        else:
 
-    ])
+            self.unrouted += 1
 
-    for gid in GROUP_IDS:
+        return chats
 
-        try:
+    def stats(self):
 
-            await bot.send_message(chat_id=gid, text=msg, parse_mode="HTML", reply_markup=keyboard)
+        return {
 
-        except Exception as e:
+            "groups": len(self.groups),
+
+            "routed": self.routed,
+
+            "unrouted": self.unrouted
+
+        }
+
+ROUTER = None
+
+def compile_routes():
 
-            print(f"Send Error -> {gid}: {e}")
+    global ROUTER
+
+    ROUTER = RoutingIndex(GROUP_IDS, GROUP_ROUTES)
+
+def set_group_routes(routes):
+
+    global GROUP_ROUTES
+
+    GROUP_ROUTES = dict(routes)
+
+    compile_routes()
+
+compile_routes()
 
 # ============================
 
-# COMMAND HANDLER LOOP
+# OTP STORAGE
 
 # ============================
 
-async def command_listener():
+OTP_UPSERT = (
 
-    offset = 0
+    "INSERT INTO otps (number, otp, updated_at, expires_at) VALUES (?, ?, ?, ?) "
 
-    while True:
+    "ON CONFLICT(number) DO UPDATE SET otp = excluded.otp, updated_at = excluded.updated_at, "
+
+    "expires_at = excluded.expires_at"
+
+)
+
+OTP_DELETE_EXPIRED = (
+
+    "DELETE FROM otps WHERE rowid IN ("
+
+    "SELECT rowid FROM otps WHERE expires_at IS NOT NULL AND expires_at <= ? LIMIT ?)"
+
+)
+
+def otp_ttl_for(service):
+
+    return OTP_TTL_BY_SERVICE.get(service.lower(), OTP_TTL)
+
+class OtpStore:
+
+    def __init__(self, path, snapshot_path):
+
+        self.path = path
+
+        self.snapshot_path = snapshot_path
+
+        self.conn = None
+
+        self.lock = threading.Lock()
+
+        self.cache = {}
+
+        self.expiries = {}
+
+        self.heap = []
+
+        self.dirty = {}
+
+        self.flush_wanted = asyncio.Event()
+
+        self.flushes = 0
+
+        self.flushed_rows = 0
+
+        self.snapshots = 0
+
+        self.expired = 0
+
+        self.expired_rows = 0
+
+    def open(self):
+
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+
+        self.conn.execute("PRAGMA journal_mode=WAL")
+
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+
+        self.conn.execute(
+
+            "CREATE TABLE IF NOT EXISTS otps ("
+
+            "number TEXT PRIMARY KEY, otp TEXT NOT NULL, updated_at REAL NOT NULL, expires_at REAL)"
+
+        )
+
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(otps)")]
+
+        if "expires_at" not in columns:
+
+            self.conn.execute("ALTER TABLE otps ADD COLUMN expires_at REAL")
+
+        self.conn.execute("CREATE INDEX IF NOT EXISTS otps_expires_at ON otps (expires_at)")
+
+        self.conn.commit()
+
+        self.migrate_json(OTP_FILE)
+
+        rows = self.conn.execute(
+
+            "SELECT number, otp, expires_at FROM otps WHERE expires_at IS NULL OR expires_at > ?",
+
+            (time.time(),)
+
+        )
+
+        for number, otp, expires_at in rows:
+
+            self.cache[number] = otp
+
+            if expires_at is not None:
+
+                self.expiries[number] = expires_at
+
+                self.heap.append((expires_at, number))
+
+        heapq.heapify(self.heap)
+
+    def migrate_json(self, path):
+
+        if not os.path.exists(path):
+
+            return
 
         try:
 
-            updates = await bot.get_updates(offset=offset, timeout=10)
+            with open(path, "r") as f:
 
-            for update in updates:
+                data = json.load(f)
 
-                offset = update.update_id + 1
+        except (OSError, ValueError) as e:
 
-                if update.message and update.message.text:
+            print("OTP Store Migration Error:", e)
 
-                    text = update.message.text
+            return
 
-                    chat_id = update.message.chat_id
+        now = time.time()
 
-                    if text.startswith("/start"):
+        expires_at = now + OTP_TTL if OTP_TTL else None
 
-                        keyboard = InlineKeyboardMarkup([
+        self.conn.executemany(OTP_UPSERT, ((str(k), str(v), now, expires_at) for k, v in data.items()))
 
-                            [
+        self.conn.commit()
 
-                                InlineKeyboardButton("Join Group", url="https://t.me/sex"),
+        os.replace(path, path + ".migrated")
 
-                                InlineKeyboardButton("Join Channel", url="https://t.me/sex")
+        print(f"[OTP STORE] Migrated {len(data)} entries from {path}")
 
-                            ],
+    def get(self, number):
 
-                            [
+        expires_at = self.expiries.get(number)
 
-                                InlineKeyboardButton("Developer", url="https://t.me/sex")
+        if expires_at is not None and expires_at <= time.time():
 
-                            ]
+            return None
 
-                        ])
+        return self.cache.get(number)
 
-                        await bot.send_message(
+    def put(self, number, otp, ttl=0):
 
-                            chat_id=chat_id,
+        now = time.time()
 
-                            text="✅ Bot is working and active\nFor more details: @sex",
+        expires_at = now + ttl if ttl else None
 
-                            reply_markup=keyboard
+        self.cache[number] = otp
 
-                        )
+        if expires_at is None:
 
-                    elif text.startswith("/otpfor"):
+            self.expiries.pop(number, None)
 
-                        parts = text.split()
+        else:
 
-                        if len(parts) < 2:
+            self.expiries[number] = expires_at
 
-                            await bot.send_message(chat_id=chat_id, text="Usage: /otpfor <number>")
+            heapq.heappush(self.heap, (expires_at, number))
 
-                            continue
+        self.dirty[number] = (otp, now, expires_at)
 
-                        number = parts[1]
+        if len(self.dirty) >= OTP_FLUSH_BATCH:
 
-                        store = load_otp_store()
+            self.flush_wanted.set()
 
-                        if number in store:
+    def _write(self, batch):
 
-                            await bot.send_message(
+        with self.lock:
 
-                                chat_id=chat_id,
+            self.conn.executemany(OTP_UPSERT, ((number, *entry) for number, entry in batch.items()))
 
-                                text=f"🔐 OTP for {number}:\n<code>{store[number]}</code>",
+            self.conn.commit()
 
-                                parse_mode="HTML"
+    def _delete_expired(self, now):
 
-                            )
+        with self.lock:
 
-                        else:
+            deleted = self.conn.execute(OTP_DELETE_EXPIRED, (now, OTP_COMPACT_CHUNK)).rowcount
 
-                            found = False
+            self.conn.commit()
 
-                            for panel in API_PANELS:
+        return deleted
 
-                                data = fetch_latest(panel)
+    async def compact(self):
 
-                                if data and number in data["number"]:
+        now = time.time()
 
-                                    otp = extract_otp(data["message"])
+        heap = self.heap
 
-                                    if otp:
+        while heap and heap[0][0] <= now:
 
-                                        store[number] = otp
+            for _ in range(OTP_COMPACT_CHUNK):
 
-                                        save_otp_store(store)
+                if not heap or heap[0][0] > now:
 
-                                        await bot.send_message(
+                    break
 
-                                            chat_id=chat_id,
+                expires_at, number = heapq.heappop(heap)
 
-                                            text=f"✅ OTP Found & Saved:\n<code>{otp}</code>",
+                # Entries re-put since this push carry a newer expiry; skip the stale heap item.
 
-                                            parse_mode="HTML"
+                if self.expiries.get(number) == expires_at:
 
-                                        )
+                    del self.expiries[number]
 
-                                        found = True
+                    del self.cache[number]
 
-                                        break
+                    self.expired += 1
 
-                            if not found:
+            await asyncio.sleep(0)
 
-                                await bot.send_message(chat_id=chat_id, text="❌ No OTP found for this number.")
+        while True:
 
-        except Exception as e:
+            try:
 
-            print("Command Listener Error:", e)
+                deleted = await asyncio.to_thread(self._delete_expired, now)
 
-        await asyncio.sleep(1)
+            except sqlite3.Error as e:
 
-# ============================
+                print("OTP Store Compaction Error:", e)
 
-# API WORKERS
+                return
 
-# ============================
+            self.expired_rows += deleted
 
-async def api_worker(panel):
+            if deleted < OTP_COMPACT_CHUNK:
 
-    print(f"[STARTED] {panel.upper()} Worker")
+                return
 
-    last = None
+    def count_expired(self, now):
 
-    while True:
+        heap = self.heap
 
-        data = fetch_latest(panel)
+        count = 0
 
-        if data:
+        stack = [0] if heap else []
 
-            if not cli_passes_filter(data["service"]):
+        while stack:
 
-                await asyncio.sleep(3)
+            i = stack.pop()
 
-                continue
+            # Heap order means a child is never due before its parent.
+
+            if i < len(heap) and heap[i][0] <= now:
 
-            uniq = data["number"] + data["message"]
+                if self.expiries.get(heap[i][1]) == heap[i][0]:
 
-            if uniq != last:
+                    count += 1
 
-                last = uniq
+                stack.extend((2 * i + 1, 2 * i + 2))
 
-                otp = extract_otp(data["message"])
+        return count
 
-                if otp:
+    async def flush(self):
 
-                    store = load_otp_store()
+        self.flush_wanted.clear()
 
-                    store[data["number"]] = otp
+        if not self.dirty:
 
-                    save_otp_store(store)
+            return
 
-                msg = format_message(data)
+        batch, self.dirty = self.dirty, {}
 
-                await send_to_all_groups(msg)
+        try:
 
-                print(f"[{panel.upper()}] Sent: {data['service']} | {data['number']}")
+            await asyncio.to_thread(self._write, batch)
 
-        await asyncio.sleep(3)
+        except sqlite3.Error as e:
 
-# ============================
+            print("OTP Store Flush Error:", e)
 
-# MAIN
+            for number, entry in batch.items():
 
-# ============================
+                self.dirty.setdefault(number, entry)
 
-async def main():
+            return
 
-    tasks = [api_worker(panel) for panel in API_PANELS]
+        self.flushes += 1
 
-    tasks.append(command_listener())
+        self.flushed_rows += len(batch)
 
-    await asyncio.gather(*tasks)
+    def _snapshot(self):
 
-if __name__ == "__main__":
+        tmp = self.snapshot_path + ".tmp"
+
+        if os.path.exists(tmp):
+
+            os.remove(tmp)
+
+        target = sqlite3.connect(tmp)
+
+        try:
+
+            with self.lock:
+
+                self.conn.backup(target)
+
+        finally:
+
+            target.close()
+
+        os.replace(tmp, self.snapshot_path)
+
+    async def snapshot(self):
+
+        try:
+
+            await asyncio.to_thread(self._snapshot)
+
+        except (OSError, sqlite3.Error) as e:
+
+            print("OTP Snapshot Error:", e)
+
+            return
+
+        self.snapshots += 1
+
+    def close(self):
+
+        if self.conn is None:
+
+            return
+
+        if self.dirty:
+
+            self._write(self.dirty)
+
+            self.dirty = {}
+
+        self.conn.close()
+
+        self.conn = None
+
+    def stats(self):
+
+        pending = self.count_expired(time.time())
+
+        return {
+
+            "entries": len(self.cache),
+
+            "live": len(self.cache) - pending,
+
+            "expired_pending": pending,
+
+            "expired": self.expired,
+
+            "expired_rows": self.expired_rows,
+
+            "dirty": len(self.dirty),
+
+            "flushes": self.flushes,
+
+            "flushed_rows": self.flushed_rows,
+
+            "snapshots": self.snapshots
+
+        }
+
+OTP_STORE = OtpStore(OTP_DB_FILE, OTP_SNAPSHOT_FILE)
+
+async def otp_store_flusher():
+
+    last_snapshot = time.monotonic()
+
+    while True:
+
+        try:
+
+            await asyncio.wait_for(OTP_STORE.flush_wanted.wait(), OTP_FLUSH_INTERVAL)
+
+        except asyncio.TimeoutError:
+
+            pass
+
+        await OTP_STORE.flush()
+
+        if OTP_SNAPSHOT_INTERVAL and time.monotonic() - last_snapshot >= OTP_SNAPSHOT_INTERVAL:
+
+            last_snapshot = time.monotonic()
+
+            await OTP_STORE.snapshot()
+
+async def otp_store_compactor():
+
+    while True:
+
+        await asyncio.sleep(OTP_COMPACT_INTERVAL)
+
+        await OTP_STORE.compact()
+
+# ============================
+
+# PANEL HTTP CLIENTS
+
+# ============================
+
+PANEL_CLIENTS = {}
+
+def panel_host(url):
+
+    parts = urlsplit(url)
+
+    return f"{parts.scheme}://{parts.netloc}"
+
+def get_panel_client(panel):
+
+    host = panel_host(API_PANELS[panel]["url"])
+
+    client = PANEL_CLIENTS.get(host)
+
+    if client is None or client.is_closed:
+
+        client = httpx.AsyncClient(
+
+            limits=httpx.Limits(
+
+                max_connections=PANEL_MAX_CONNECTIONS,
+
+                max_keepalive_connections=PANEL_MAX_CONNECTIONS,
+
+                keepalive_expiry=PANEL_KEEPALIVE_EXPIRY
+
+            ),
+
+            timeout=PANEL_TIMEOUT
+
+        )
+
+        PANEL_CLIENTS[host] = client
+
+    return client
+
+async def close_panel_clients():
+
+    for client in PANEL_CLIENTS.values():
+
+        await client.aclose()
+
+    PANEL_CLIENTS.clear()
+
+# ============================
+
+# CIRCUIT BREAKERS
+
+# ============================
+
+BREAKER_FAILURE_THRESHOLD = 3
+
+BREAKER_BASE_DELAY = 5
+
+BREAKER_MAX_DELAY = 300
+
+BREAKER_TRIAL_TIMEOUT = 30
+
+BREAKER_CLOSED = "closed"
+
+BREAKER_OPEN = "open"
+
+BREAKER_HALF_OPEN = "half_open"
+
+class CircuitBreaker:
+
+    def __init__(self, panel):
+
+        self.panel = panel
+
+        self.state = BREAKER_CLOSED
+
+        self.failures = 0
+
+        self.trips = 0
+
+        self.retry_at = 0
+
+        self.trial_started = 0
+
+        self.transitions = {}
+
+        self.fast_fails = 0
+
+    def _transition(self, state):
+
+        key = f"{self.state}->{state}"
+
+        self.transitions[key] = self.transitions.get(key, 0) + 1
+
+        self.state = state
+
+    def allow(self):
+
+        if self.state == BREAKER_CLOSED:
+
+            return True
+
+        now = time.monotonic()
+
+        if self.state == BREAKER_OPEN and now >= self.retry_at:
+
+            # Let exactly one trial request through.
+
+            self._transition(BREAKER_HALF_OPEN)
+
+            self.trial_started = now
+
+            return True
+
+        if self.state == BREAKER_HALF_OPEN and now - self.trial_started >= BREAKER_TRIAL_TIMEOUT:
+
+            # The previous trial never reported back (e.g. it was cancelled).
+
+            self.trial_started = now
+
+            return True
+
+        self.fast_fails += 1
+
+        return False
+
+    def record_success(self):
+
+        if self.state != BREAKER_CLOSED:
+
+            print(f"[{self.panel.upper()}] Circuit closed")
+
+            self._transition(BREAKER_CLOSED)
+
+            self.trips = 0
+
+        self.failures = 0
+
+    def record_failure(self):
+
+        self.failures += 1
+
+        if self.state == BREAKER_HALF_OPEN or (self.state == BREAKER_CLOSED and self.failures >= BREAKER_FAILURE_THRESHOLD):
+
+            self.trips += 1
+
+            ceiling = min(BREAKER_MAX_DELAY, BREAKER_BASE_DELAY * 2 ** (self.trips - 1))
+
+            delay = ceiling / 2 + random.uniform(0, ceiling / 2)
+
+            self.retry_at = time.monotonic() + delay
+
+            print(f"[{self.panel.upper()}] Circuit open for {delay:.1f}s after {self.failures} failures")
+
+            self._transition(BREAKER_OPEN)
+
+    def remaining(self):
+
+        if self.state != BREAKER_OPEN:
+
+            return 0
+
+        return max(0, self.retry_at - time.monotonic())
+
+    def stats(self):
+
+        return {
+
+            "state": self.state,
+
+            "failures": self.failures,
+
+            "trips": self.trips,
+
+            "fast_fails": self.fast_fails,
+
+            "transitions": dict(self.transitions)
+
+        }
+
+PANEL_BREAKERS = {}
+
+def panel_breaker(panel):
+
+    breaker = PANEL_BREAKERS.get(panel)
+
+    if breaker is None:
+
+        breaker = PANEL_BREAKERS[panel] = CircuitBreaker(panel)
+
+    return breaker
+
+# ============================
+
+# LATENCY HISTOGRAMS & HEDGING
+
+# ============================
+
+LATENCY_MIN = 0.005
+
+LATENCY_GROWTH = 1.25
+
+LATENCY_DECAY_AT = 1000
+
+HEDGE_ENABLED = False
+
+HEDGE_QUANTILE = 0.9
+
+HEDGE_MIN_SAMPLES = 20
+
+HEDGE_MIN_DELAY = 0.05
+
+HEDGE_BUDGET_RATIO = 0.05
+
+HEDGE_BUDGET_BURST = 10
+
+class LatencyHistogram:
+
+    # Log-scale buckets, ~25% wide; halved every LATENCY_DECAY_AT samples so
+
+    # the quantiles follow the panel's recent behaviour.
+
+    def __init__(self):
+
+        self.counts = {}
+
+        self.total = 0
+
+        self.samples = 0
+
+    def observe(self, seconds):
+
+        index = max(0, int(math.log(max(seconds, LATENCY_MIN) / LATENCY_MIN, LATENCY_GROWTH)))
+
+        self.counts[index] = self.counts.get(index, 0) + 1
+
+        self.total += 1
+
+        self.samples += 1
+
+        if self.total >= LATENCY_DECAY_AT:
+
+            self.counts = {i: c // 2 for i, c in self.counts.items() if c // 2}
+
+            self.total = sum(self.counts.values())
+
+    def quantile(self, q):
+
+        if not self.total:
+
+            return None
+
+        rank = q * self.total
+
+        seen = 0
+
+        for index in sorted(self.counts):
+
+            seen += self.counts[index]
+
+            if seen >= rank:
+
+                return LATENCY_MIN * LATENCY_GROWTH ** (index + 1)
+
+        return LATENCY_MIN * LATENCY_GROWTH ** (max(self.counts) + 1)
+
+    def stats(self):
+
+        def ms(q):
+
+            value = self.quantile(q)
+
+            return round(value * 1000, 1) if value is not None else None
+
+        return {"samples": self.samples, "p50_ms": ms(0.5), "p90_ms": ms(0.9), "p99_ms": ms(0.99)}
+
+class HedgeBudget:
+
+    # Every primary request earns HEDGE_BUDGET_RATIO of a token and every hedge
+
+    # spends one, so hedges stay under that fraction of total panel load.
+
+    def __init__(self, ratio, burst):
+
+        self.ratio = ratio
+
+        self.burst = burst
+
+        self.tokens = burst
+
+        self.fired = 0
+
+        self.won = 0
+
+        self.denied = 0
+
+    def earn(self):
+
+        self.tokens = min(self.burst, self.tokens + self.ratio)
+
+    def take(self):
+
+        if self.tokens < 1:
+
+            self.denied += 1
+
+            return False
+
+        self.tokens -= 1
+
+        self.fired += 1
+
+        return True
+
+    def stats(self):
+
+        return {"tokens": round(self.tokens, 2), "fired": self.fired, "won": self.won, "denied": self.denied}
+
+HEDGE_BUDGET = HedgeBudget(HEDGE_BUDGET_RATIO, HEDGE_BUDGET_BURST)
+
+PANEL_LATENCY = {}
+
+def panel_latency(panel):
+
+    histogram = PANEL_LATENCY.get(panel)
+
+    if histogram is None:
+
+        histogram = PANEL_LATENCY[panel] = LatencyHistogram()
+
+    return histogram
+
+def hedge_delay(panel):
+
+    histogram = panel_latency(panel)
+
+    if not HEDGE_ENABLED or histogram.samples < HEDGE_MIN_SAMPLES:
+
+        return None
+
+    return max(HEDGE_MIN_DELAY, histogram.quantile(HEDGE_QUANTILE))
+
+async def hedged_get(panel, url, params, timeout):
+
+    client = get_panel_client(panel)
+
+    started = time.perf_counter()
+
+    HEDGE_BUDGET.earn()
+
+    primary = asyncio.ensure_future(client.get(url, params=params, timeout=timeout))
+
+    pending = {primary}
+
+    try:
+
+        delay = hedge_delay(panel)
+
+        if delay is not None:
+
+            done, _ = await asyncio.wait(pending, timeout=delay)
+
+            if not done and HEDGE_BUDGET.take():
+
+                pending.add(asyncio.ensure_future(client.get(url, params=params, timeout=timeout)))
+
+        error = None
+
+        while pending:
+
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+
+            for task in done:
+
+                if task.exception() is None:
+
+                    if task is not primary:
+
+                        HEDGE_BUDGET.won += 1
+
+                    # A hedge win still records the full wait since the primary
+
+                    # was sent, which is a lower bound on the panel's latency.
+
+                    panel_latency(panel).observe(time.perf_counter() - started)
+
+                    return task.result()
+
+                error = task.exception()
+
+        raise error
+
+    finally:
+
+        for task in pending:
+
+            task.cancel()
+
+# ============================
+
+# FETCH FUNCTIONS
+
+# ============================
+
+# Record field -> key in the panel's JSON rows; panels can override any of these.
+
+RECORD_FIELDS = {
+
+    "time": "dt",
+
+    "number": "num",
+
+    "service": "cli",
+
+    "message": "message"
+
+}
+
+def normalize_record(raw, fields=RECORD_FIELDS):
+
+    return {name: raw.get(key, "") for name, key in fields.items()}
+
+async def fetch_records(panel):
+
+    cfg = API_PANELS.get(panel)
+
+    if cfg is None:
+
+        return None
+
+    breaker = panel_breaker(panel)
+
+    if not breaker.allow():
+
+        return None
+
+    try:
+
+        sizer = PAGE_SIZERS.get(panel)
+
+        response = await hedged_get(panel, cfg["url"], {
+
+            "token": cfg["token"],
+
+            "records": sizer.size if sizer else cfg["records"]
+
+        }, cfg.get("timeout", PANEL_TIMEOUT))
+
+        data = response.json()
+
+        if data.get("status") != "success":
+
+            print(f"{panel.upper()} API Error:", data)
+
+            breaker.record_failure()
+
+            return None
+
+        fields = cfg.get("fields", RECORD_FIELDS)
+
+        records = [normalize_record(r, fields) for r in reversed(data.get("data") or [])]
+
+        # Panels return newest first; a stable sort on dt keeps that order for ties.
+
+        records.sort(key=lambda r: r["time"])
+
+        breaker.record_success()
+
+        return records
+
+    except Exception as e:
+
+        print(f"{panel.upper()} Fetch Error:", e)
+
+        breaker.record_failure()
+
+        return None
+
+# ============================
+
+# PANEL CURSORS
+
+# ============================
+
+PANEL_CURSORS = {}
+
+def record_fingerprint(record):
+
+    raw = "\x1f".join((record["time"], record["number"], record["service"], record["message"]))
+
+    return hashlib.blake2b(raw.encode("utf-8"), digest_size=8).hexdigest()
+
+# Returns the new records and the advanced cursor; the caller publishes the
+
+# cursor only once those records are safely spooled.
+
+def take_new_records(panel, records):
+
+    if not records:
+
+        return [], None
+
+    cursor = PANEL_CURSORS.get(panel)
+
+    if cursor is None:
+
+        fresh = records[-PANEL_BACKFILL_ON_START:] if PANEL_BACKFILL_ON_START > 0 else []
+
+        cursor = {"time": "", "seen": []}
+
+    else:
+
+        fresh = [
+
+            r for r in records
+
+            if r["time"] > cursor["time"]
+
+            or (r["time"] == cursor["time"] and record_fingerprint(r) not in cursor["seen"])
+
+        ]
+
+    top = records[-1]["time"]
+
+    if top < cursor["time"]:
+
+        return fresh, None
+
+    seen = set(cursor["seen"]) if top == cursor["time"] else set()
+
+    seen.update(record_fingerprint(r) for r in records if r["time"] == top)
+
+    return fresh, {"time": top, "seen": sorted(seen)}
+
+# ============================
+
+# DEDUP CACHE
+
+# ============================
+
+DEDUP_MAX_ENTRIES = 50000
+
+DEDUP_TTL = 6 * 60 * 60
+
+class DedupCache:
+
+    def __init__(self, max_entries, ttl):
+
+        self.max_entries = max_entries
+
+        self.ttl = ttl
+
+        self.entries = OrderedDict()
+
+        self.hits = 0
+
+        self.misses = 0
+
+        self.evictions = 0
+
+        self.expired = 0
+
+    def _expire(self, now):
+
+        entries = self.entries
+
+        while entries:
+
+            key, ts = next(iter(entries.items()))
+
+            if now - ts < self.ttl:
+
+                break
+
+            entries.popitem(last=False)
+
+            self.expired += 1
+
+    def seen(self, key, now=None):
+
+        now = time.time() if now is None else now
+
+        self._expire(now)
+
+        entries = self.entries
+
+        if key not in entries:
+
+            return False
+
+        entries[key] = now
+
+        entries.move_to_end(key)
+
+        self.hits += 1
+
+        return True
+
+    def add(self, key, now=None):
+
+        now = time.time() if now is None else now
+
+        entries = self.entries
+
+        entries[key] = now
+
+        entries.move_to_end(key)
+
+        self.misses += 1
+
+        if len(entries) > self.max_entries:
+
+            entries.popitem(last=False)
+
+            self.evictions += 1
+
+    def dump(self, limit):
+
+        items = list(self.entries.items())[-limit:] if limit > 0 else []
+
+        return [[key.hex(), ts] for key, ts in items]
+
+    def restore(self, items, now=None):
+
+        now = time.time() if now is None else now
+
+        for key, ts in sorted(items, key=lambda item: item[1]):
+
+            if now - ts < self.ttl:
+
+                self.entries[bytes.fromhex(key)] = ts
+
+        while len(self.entries) > self.max_entries:
+
+            self.entries.popitem(last=False)
+
+    def stats(self):
+
+        return {
+
+            "size": len(self.entries),
+
+            "hits": self.hits,
+
+            "misses": self.misses,
+
+            "evictions": self.evictions,
+
+            "expired": self.expired
+
+        }
+
+DEDUP = DedupCache(DEDUP_MAX_ENTRIES, DEDUP_TTL)
+
+def dedup_key(panel, record):
+
+    raw = "\x1f".join((panel, record["number"], record["message"]))
+
+    return hashlib.blake2b(raw.encode("utf-8"), digest_size=8).digest()
+
+# ============================
+
+# PERSISTENT STATE
+
+# ============================
+
+STATE_FILE = "bot_state.json"
+
+STATE_FLUSH_INTERVAL = 2
+
+STATE_DEDUP_LIMIT = 5000
+
+UPDATE_OFFSET = 0
+
+STATE_DIRTY = False
+
+def mark_state_dirty():
+
+    global STATE_DIRTY
+
+    STATE_DIRTY = True
+
+def load_state():
+
+    global UPDATE_OFFSET
+
+    if not os.path.exists(STATE_FILE):
+
+        return
+
+    try:
+
+        with open(STATE_FILE, "r") as f:
+
+            state = json.load(f)
+
+    except (OSError, ValueError) as e:
+
+        print("State Load Error:", e)
+
+        return
+
+    PANEL_CURSORS.update(state.get("cursors", {}))
+
+    DEDUP.restore(state.get("dedup", []))
+
+    UPDATE_OFFSET = state.get("offset", 0)
+
+    print(f"[STATE] Restored {len(PANEL_CURSORS)} cursors, {len(DEDUP.entries)} fingerprints, offset {UPDATE_OFFSET}")
+
+def snapshot_state():
+
+    return {
+
+        "cursors": dict(PANEL_CURSORS),
+
+        "dedup": DEDUP.dump(STATE_DEDUP_LIMIT),
+
+        "offset": UPDATE_OFFSET
+
+    }
+
+def write_state(state):
+
+    tmp = STATE_FILE + ".tmp"
+
+    with open(tmp, "w") as f:
+
+        json.dump(state, f, separators=(",", ":"))
+
+        f.flush()
+
+        os.fsync(f.fileno())
+
+    os.replace(tmp, STATE_FILE)
+
+async def flush_state():
+
+    global STATE_DIRTY
+
+    if not STATE_DIRTY:
+
+        return
+
+    STATE_DIRTY = False
+
+    try:
+
+        await asyncio.to_thread(write_state, snapshot_state())
+
+    except OSError as e:
+
+        STATE_DIRTY = True
+
+        print("State Save Error:", e)
+
+async def state_flusher():
+
+    while True:
+
+        await asyncio.sleep(STATE_FLUSH_INTERVAL)
+
+        await flush_state()
+
+# ============================
+
+# HELPERS
+
+# ============================
+
+OTP_NUMBER = re.compile(r"\d(?<!\d\d)(?:\d\d[- ]\d{3}|\d{3,7})(?!\d)")
+
+OTP_SCANNER = re.compile(
+
+    # The lookahead lets most positions skip the keyword branch with one class test.
+
+    r"(?=[ocpv验кرك])(?P<keyword>otp|code|pin|passcode|password|verification|one[- ]time|验证码|код|رمز|كود)|"
+
+    # Sentence ends: a keyword never vouches for a number across one.
+
+    r"(?P<stop>[.!?。](?!\S)|\n)|"
+
+    + OTP_NUMBER.pattern,
+
+    re.IGNORECASE
+
+)
+
+# Currency words only count as whole words: "Rs 500" but not "users 500".
+
+OTP_CURRENCY_BEFORE = re.compile(r"(?<![^\W\d_])(?:rs\.?|inr|usd|eur|bdt|tk)\s*$", re.IGNORECASE)
+
+OTP_CURRENCY_ENDINGS = frozenset(("rs", "s.", "nr", "sd", "ur", "dt", "tk"))
+
+OTP_BAD_AFTER = re.compile(r"[.,:\- ]\d")
+
+OTP_LENGTH_SCORES = {4: 20, 5: 25, 6: 30, 7: 12, 8: 12}
+
+OTP_SPLIT_SCORE = 28
+
+OTP_KEYWORD_BONUS = 40
+
+OTP_KEYWORD_BEFORE_BONUS = 15
+
+OTP_KEYWORD_WINDOW = 24
+
+OTP_CONTEXT_WINDOW = 8
+
+# Phone numbers (+91...), amounts (Rs.2500, 1,250, $40) and times (10:30).
+
+def otp_bad_before(message, start):
+
+    head = message[max(0, start - OTP_CONTEXT_WINDOW):start].rstrip()
+
+    tail = head[-1:]
+
+    if not tail:
+
+        return False
+
+    if tail in "+$₹€£" or (tail in "-.,:" and head[-2:-1].isdigit()):
+
+        return True
+
+    return head[-2:].lower() in OTP_CURRENCY_ENDINGS and OTP_CURRENCY_BEFORE.search(message, 0, start) is not None
+
+def otp_context_score(message, start, end):
+
+    span = end - start
+
+    score = OTP_LENGTH_SCORES.get(span, OTP_SPLIT_SCORE)
+
+    if otp_bad_before(message, start):
+
+        score -= 45
+
+    if OTP_BAD_AFTER.match(message, end):
+
+        score -= 40
+
+    if span == 4 and message[start:start + 2] in ("19", "20"):
+
+        score -= 8
+
+    return score
+
+def rank_otp_candidates(message):
+
+    best = None
+
+    best_score = 0
+
+    last = None
+
+    last_score = 0
+
+    keyword_end = -OTP_KEYWORD_WINDOW - 1
+
+    for match in OTP_SCANNER.finditer(message):
+
+        start, end = match.span()
+
+        kind = match.lastgroup
+
+        if kind == "stop":
+
+            keyword_end = -OTP_KEYWORD_WINDOW - 1
+
+            last = None
+
+            continue
+
+        if kind:
+
+            keyword_end = end
+
+            # "123456 is your code": the keyword also vouches, less strongly, for the number just before it.
+
+            if last is not None and start - last[1] <= OTP_KEYWORD_WINDOW:
+
+                last_score += OTP_KEYWORD_BEFORE_BONUS
+
+                if last_score > best_score:
+
+                    best, best_score = last, last_score
+
+                last = None
+
+            continue
+
+        score = otp_context_score(message, start, end)
+
+        # The first plausible number after a keyword is the one it labels.
+
+        if start - keyword_end <= OTP_KEYWORD_WINDOW:
+
+            if score > 0:
+
+                keyword_end = -OTP_KEYWORD_WINDOW - 1
+
+            score += OTP_KEYWORD_BONUS
+
+        last, last_score = (start, end), score
+
+        if score > best_score:
+
+            best, best_score = last, score
+
+    return message[best[0]:best[1]] if best else None
+
+def extract_otp_generic(message):
+
+    first = OTP_NUMBER.search(message)
+
+    if first is None:
+
+        return None
+
+    start, end = first.span()
+
+    # Most SMS carry a single, cleanly delimited code; only rank by context when there is a choice.
+
+    if OTP_NUMBER.search(message, end) is None and OTP_BAD_AFTER.match(message, end) is None and not otp_bad_before(message, start):
+
+        return first.group()
+
+    return rank_otp_candidates(message)
+
+# ============================
+
+# OTP RULES
+
+# ============================
+
+OTP_RULES_FILE = "otp_rules.json"
+
+OTP_RULES_RELOAD_INTERVAL = 10
+
+# Patterns are tried in order; the first capture group (or the whole match) is the OTP.
+
+# otp_rules.json uses the same shape and overrides these per service; [] disables a default.
+
+DEFAULT_OTP_RULES = {
+
+    "whatsapp": [r"\b(\d{3}-\d{3})\b"],
+
+    "telegram": [r"(?:code|код)\D{0,12}?(\d{5,6})\b"],
+
+    "google": [r"\bG-(\d{6})\b"],
+
+    "facebook": [r"\bFB-(\d{5,8})\b", r"code\D{0,12}?(\d{5,8})\b"],
+
+    "instagram": [r"\b(\d{3} ?\d{3})\b"]
+
+}
+
+@functools.lru_cache(maxsize=4096)
+
+def normalize_cli(cli):
+
+    return "".join(ch for ch in cli.lower() if ch.isalnum())
+
+class OtpRules:
+
+    def __init__(self, rules):
+
+        self.rules = {}
+
+        for service, patterns in rules.items():
+
+            compiled = []
+
+            for pattern in patterns:
+
+                try:
+
+                    compiled.append(re.compile(pattern, re.IGNORECASE))
+
+                except re.error as e:
+
+                    print(f"OTP Rule Error ({service}): {e}")
+
+            self.rules[normalize_cli(service)] = compiled
+
+        self.rule_hits = 0
+
+        self.fallbacks = 0
+
+    def extract(self, message, service):
+
+        for pattern in self.rules.get(normalize_cli(service), ()):
+
+            match = pattern.search(message)
+
+            if match:
+
+                self.rule_hits += 1
+
+                return match.group(1 if match.re.groups else 0)
+
+        self.fallbacks += 1
+
+        return extract_otp_generic(message)
+
+    def stats(self):
+
+        return {
+
+            "services": len(self.rules),
+
+            "rule_hits": self.rule_hits,
+
+            "fallbacks": self.fallbacks
+
+        }
+
+OTP_RULES = OtpRules(DEFAULT_OTP_RULES)
+
+OTP_RULES_MTIME = None
+
+def load_otp_rules():
+
+    global OTP_RULES, OTP_RULES_MTIME
+
+    try:
+
+        mtime = os.stat(OTP_RULES_FILE).st_mtime
+
+    except OSError:
+
+        if OTP_RULES_MTIME is not None:
+
+            OTP_RULES_MTIME = None
+
+            OTP_RULES = OtpRules(DEFAULT_OTP_RULES)
+
+            print(f"[OTP RULES] {OTP_RULES_FILE} removed, using built-in rules")
+
+        return
+
+    if mtime == OTP_RULES_MTIME:
+
+        return
+
+    OTP_RULES_MTIME = mtime
+
+    try:
+
+        with open(OTP_RULES_FILE, "r", encoding="utf-8") as f:
+
+            overrides = json.load(f)
+
+        if not isinstance(overrides, dict):
+
+            raise ValueError("top level must be an object")
+
+        for service, patterns in overrides.items():
+
+            # A bare string would otherwise be split into one-character patterns.
+
+            if not isinstance(patterns, list) or not all(isinstance(pattern, str) for pattern in patterns):
+
+                raise ValueError(f"{service}: expected a list of pattern strings")
+
+        rules = OtpRules(dict(DEFAULT_OTP_RULES, **overrides))
+
+    except (OSError, TypeError, ValueError) as e:
+
+        print("OTP Rules Load Error:", e)
+
+        return
+
+    OTP_RULES = rules
+
+    print(f"[OTP RULES] Loaded {len(overrides)} service rules from {OTP_RULES_FILE}")
+
+async def otp_rules_watcher():
+
+    while True:
+
+        await asyncio.sleep(OTP_RULES_RELOAD_INTERVAL)
+
+        load_otp_rules()
+
+def extract_otp(message, service=""):
+
+    if service:
+
+        return OTP_RULES.extract(message, service)
+
+    return extract_otp_generic(message)
+
+def extract_otp_regex_loop(message):
+
+    for pat in [r'\d{6}', r'\d{4}', r'\d{3}-\d{3}']:
+
+        match = re.search(pat, message)
+
+        if match:
+
+            return match.group(0)
+
+    return None
+
+# Labelled SMS ({"message": ..., "otp": ...}) that --bench-otp also checks for accuracy.
+
+OTP_CORPUS_FILE = "otp_corpus.jsonl"
+
+def load_sms_corpus(path):
+
+    samples = []
+
+    with open(path, "r", encoding="utf-8") as f:
+
+        for line in f:
+
+            line = line.rstrip("\n")
+
+            expected = False
+
+            if line.startswith("{"):
+
+                try:
+
+                    record = json.loads(line)
+
+                except ValueError:
+
+                    record = None
+
+                if isinstance(record, dict):
+
+                    line = record.get("message", "")
+
+                    expected = record.get("otp", False)
+
+            if line:
+
+                samples.append((line, expected))
+
+    return samples
+
+def bench_extract_otp(path, rounds=5):
+
+    samples = load_sms_corpus(path)
+
+    if not samples:
+
+        print("Empty corpus:", path)
+
+        return
+
+    messages = [message for message, _ in samples]
+
+    for name, extractor in (("regex_loop", extract_otp_regex_loop), ("engine", extract_otp)):
+
+        started = time.perf_counter()
+
+        for _ in range(rounds):
+
+            for message in messages:
+
+                extractor(message)
+
+        elapsed = time.perf_counter() - started
+
+        print(f"{name}: {len(messages) * rounds / elapsed:,.0f} msg/s")
+
+    changed = sum(1 for message in messages if extract_otp(message) != extract_otp_regex_loop(message))
+
+    ranked = sum(1 for message in messages if len(OTP_NUMBER.findall(message)) > 1)
+
+    print(f"{len(messages)} messages, {changed} extract differently, {ranked} with several candidates")
+
+    labelled = [(message, expected) for message, expected in samples if expected is not False]
+
+    if not labelled:
+
+        return
+
+    for name, extractor in (("regex_loop", extract_otp_regex_loop), ("engine", extract_otp)):
+
+        correct = sum(1 for message, expected in labelled if extractor(message) == expected)
+
+        print(f"{name}: {correct}/{len(labelled)} labelled messages correct")
+
+    for message, expected in labelled:
+
+        got = extract_otp(message)
+
+        if got != expected:
+
+            print(f"  MISS expected {expected!r} got {got!r}: {message}")
+
+def mask_number(number_str):
+
+    try:
+
+        number_str = f"+{number_str}"
+
+        length = len(number_str)
+
+        show_first = 5 if length >= 10 else 4
+
+        show_last = 4 if length >= 10 else 2
+
+        stars = "*" * (length - show_first - show_last)
+
+        return f"{number_str[:show_first]}{stars}{number_str[-show_last:]}"
+
+    except:
+
+        return f"+{number_str}"
+
+COUNTRY_CACHE_SIZE = 50000
+
+ENRICHMENT_WARM_UP = True
+
+ENRICHMENT_MODULES = None
+
+COUNTRY_PREFIXES = None
+
+# phonenumbers and its geocoder metadata are heavy; load them on first use or from the warm-up task.
+
+def enrichment_modules():
+
+    global ENRICHMENT_MODULES
+
+    if ENRICHMENT_MODULES is None:
+
+        started = time.perf_counter()
+
+        import phonenumbers
+
+        from phonenumbers import geocoder
+
+        STARTUP_TIMINGS["import_phonenumbers"] = time.perf_counter() - started
+
+        ENRICHMENT_MODULES = (phonenumbers, geocoder)
+
+    return ENRICHMENT_MODULES
+
+def region_flag(region):
+
+    if not region or len(region) != 2 or not region.isalpha():
+
+        return "🌍"
+
+    base = 127462 - ord("A")
+
+    return chr(base + ord(region[0])) + chr(base + ord(region[1]))
+
+def build_country_prefixes():
+
+    phonenumbers, geocoder = enrichment_modules()
+
+    started = time.perf_counter()
+
+    table = {}
+
+    for code, regions in phonenumbers.COUNTRY_CODE_TO_REGION_CODE.items():
+
+        if len(regions) == 1:
+
+            name = geocoder.country_name_for_number(phonenumbers.PhoneNumber(country_code=code), "en")
+
+            table[str(code)] = (name or "Unknown", region_flag(regions[0]))
+
+        else:
+
+            # Shared calling codes (NANP, +7, +44, ...) need the full number to pick a region.
+
+            table[str(code)] = None
+
+    STARTUP_TIMINGS["build_country_prefixes"] = time.perf_counter() - started
+
+    return table
+
+def country_prefixes():
+
+    global COUNTRY_PREFIXES
+
+    if COUNTRY_PREFIXES is None:
+
+        COUNTRY_PREFIXES = build_country_prefixes()
+
+    return COUNTRY_PREFIXES
+
+@functools.lru_cache(maxsize=COUNTRY_CACHE_SIZE)
+
+def parse_country_info(number_str):
+
+    phonenumbers, geocoder = enrichment_modules()
+
+    try:
+
+        parsed = phonenumbers.parse("+" + number_str)
+
+        country_name = geocoder.country_name_for_number(parsed, "en")
+
+        region = phonenumbers.region_code_for_number(parsed)
+
+        return country_name or "Unknown", region_flag(region)
+
+    except:
+
+        return "Unknown", "🌍"
+
+def get_country_info(number_str):
+
+    digits = number_str[1:] if number_str.startswith("+") else number_str
+
+    prefixes = COUNTRY_PREFIXES or country_prefixes()
+
+    for length in (1, 2, 3):
+
+        prefix = digits[:length]
+
+        if prefix in prefixes:
+
+            info = prefixes[prefix]
+
+            if info is not None:
+
+                return info
+
+            break
+
+    return parse_country_info(digits)
+
+def warm_up_enrichment_sync():
+
+    started = time.perf_counter()
+
+    phonenumbers, geocoder = enrichment_modules()
+
+    country_prefixes()
+
+    # Load region metadata for shared calling codes so the first NANP/+7/+44 record doesn't pay for it.
+
+    for regions in phonenumbers.COUNTRY_CODE_TO_REGION_CODE.values():
+
+        if len(regions) > 1:
+
+            for region in regions:
+
+                example = phonenumbers.example_number(region)
+
+                if example is not None:
+
+                    parse_country_info(f"{example.country_code}{example.national_number}")
+
+    STARTUP_TIMINGS["enrichment_warm_up"] = time.perf_counter() - started
+
+async def warm_up_enrichment():
+
+    try:
+
+        await asyncio.to_thread(warm_up_enrichment_sync)
+
+    except Exception as e:
+
+        print("Enrichment Warm-up Error:", e)
+
+        return
+
+    print("[STARTUP]", startup_report())
+
+def startup_report():
+
+    return " ".join(f"{name}={seconds * 1000:.1f}ms" for name, seconds in STARTUP_TIMINGS.items())
+
+ENRICH_CACHE_SIZE = 100000
+
+@functools.lru_cache(maxsize=ENRICH_CACHE_SIZE)
+
+def enrich_number(number_str):
+
+    country, flag = get_country_info(number_str)
+
+    return mask_number(number_str), country, flag
+
+def cache_stats(cached):
+
+    info = cached.cache_info()
+
+    lookups = info.hits + info.misses
+
+    return dict(info._asdict(), hit_rate=round(info.hits / lookups, 4) if lookups else 0.0)
+
+# ============================
+
+# MESSAGE TEMPLATES
+
+# ============================
+
+MESSAGE_TEMPLATES = {
+
+    "default": """
+
+<b>{flag} New {service} OTP!</b>
+<blockquote>🕐 Time: {time}</blockquote>
+<blockquote>{flag} Country: {country}</blockquote>
+<blockquote>📊 Service: {service}</blockquote>
+<blockquote>🔢 Number: {number}</blockquote>
+<blockquote>💠 OTP: <code>{otp}</code></blockquote>
+<blockquote>📝 Full Message:</blockquote>
+<pre>{message}</pre>
+Powered by ❤️ <b> Prime OTP </b> ❤️ 
+Support 👥 <strong>  </strong> 👥
+
+""",
+
+    "compact": "<b>{flag} {service}</b> {number}\n💠 OTP: <code>{otp}</code>",
+
+    "digest": "{flag} <b>{service}</b> {number} ➜ <code>{otp}</code>"
+
+}
+
+GROUP_TEMPLATES = {}
+
+SERVICE_TEMPLATES = {}
+
+TEMPLATE_FIELDS = {"flag", "service", "time", "country", "number", "otp", "message"}
+
+TEMPLATE_FIELD = re.compile(r"\{(\w+)\}")
+
+class MessageTemplate:
+
+    def __init__(self, source):
+
+        pieces = TEMPLATE_FIELD.split(source)
+
+        self.head = pieces[0]
+
+        self.plan = list(zip(pieces[1::2], pieces[2::2]))
+
+        unknown = {field for field, _ in self.plan} - TEMPLATE_FIELDS
+
+        if unknown:
+
+            raise ValueError(f"unknown template fields: {', '.join(sorted(unknown))}")
+
+    def render(self, values):
+
+        parts = [self.head]
+
+        for field, literal in self.plan:
+
+            parts.append(values[field])
+
+            parts.append(literal)
+
+        return "".join(parts)
+
+COMPILED_TEMPLATES = {}
+
+def build_templates(sources):
+
+    compiled = {}
+
+    for name, source in sources.items():
+
+        if not isinstance(source, str):
+
+            raise TypeError(f"template {name} must be a string")
+
+        try:
+
+            compiled[name] = MessageTemplate(source)
+
+        except ValueError as e:
+
+            print(f"Template Error ({name}): {e}")
+
+    return compiled
+
+def compile_templates():
+
+    global COMPILED_TEMPLATES
+
+    COMPILED_TEMPLATES = build_templates(MESSAGE_TEMPLATES)
+
+compile_templates()
+
+def template_for(chat_id, service):
+
+    name = GROUP_TEMPLATES.get(chat_id) or SERVICE_TEMPLATES.get(normalize_cli(service))
+
+    return name if name in COMPILED_TEMPLATES else "default"
+
+def message_values(record, otp):
+
+    masked, country, flag = enrich_number(record["number"])
+
+    return {
+
+        "flag": flag,
+
+        "service": html.escape(record["service"], quote=False),
+
+        "time": html.escape(record["time"], quote=False),
+
+        "country": country,
+
+        "number": masked,
+
+        "otp": html.escape(str(otp), quote=False),
+
+        "message": html.escape(record["message"], quote=False)
+
+    }
+
+def render_messages(record, otp, names):
+
+    values = message_values(record, otp)
+
+    return {name: COMPILED_TEMPLATES[name].render(values) for name in names}
+
+def format_message(record, template="default"):
+
+    otp = extract_otp(record["message"], record["service"])
+
+    return render_messages(record, otp, [template])[template]
+
+# ============================
+
+# TELEGRAM DELIVERY
+
+# ============================
+
+GLOBAL_SEND_RATE = 25
+
+GROUP_SEND_PER_MINUTE = 20
+
+GROUP_SEND_BURST = 3
+
+class TokenBucket:
+
+    def __init__(self, rate, capacity):
+
+        self.rate = rate
+
+        self.capacity = capacity
+
+        self.tokens = capacity
+
+        self.updated = time.monotonic()
+
+        self.blocked_until = 0
+
+    async def acquire(self):
+
+        while True:
+
+            now = time.monotonic()
+
+            wait = self.blocked_until - now
+
+            if wait <= 0:
+
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+
+                self.updated = now
+
+                if self.tokens >= 1:
+
+                    self.tokens -= 1
+
+                    return
+
+                wait = (1 - self.tokens) / self.rate
+
+            await asyncio.sleep(wait)
+
+    def pause(self, seconds):
+
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+GLOBAL_BUCKET = TokenBucket(GLOBAL_SEND_RATE, GLOBAL_SEND_RATE)
+
+CHAT_BUCKETS = {}
+
+SEND_STATS = {"sent": 0, "failed": 0, "rejected": 0, "retry_after": 0}
+
+OTP_KEYBOARD = InlineKeyboardMarkup([
+
+    [
+
+        InlineKeyboardButton("🧮 Numbers", url="https://t.me/sex"),
+
+        InlineKeyboardButton("💌 Discussion", url="https://t.me/sex")
+
+    ],
+
+    [
+
+        InlineKeyboardButton("👨‍💻 Developer", url="https://t.me/sex"),
+
+        InlineKeyboardButton("✅ OTP", url="https://t.me/sex")
+
+    ]
+
+])
+
+START_KEYBOARD = InlineKeyboardMarkup([
+
+    [
+
+        InlineKeyboardButton("Join Group", url="https://t.me/sex"),
+
+        InlineKeyboardButton("Join Channel", url="https://t.me/sex")
+
+    ],
+
+    [
+
+        InlineKeyboardButton("Developer", url="https://t.me/sex")
+
+    ]
+
+])
+
+# reply_markup is sent as a JSON string; python-telegram-bot passes strings through as-is.
+
+OTP_KEYBOARD_JSON = json.dumps(OTP_KEYBOARD.to_dict())
+
+START_KEYBOARD_JSON = json.dumps(START_KEYBOARD.to_dict())
+
+def chat_bucket(chat_id):
+
+    bucket = CHAT_BUCKETS.get(chat_id)
+
+    if bucket is None:
+
+        bucket = CHAT_BUCKETS[chat_id] = TokenBucket(GROUP_SEND_PER_MINUTE / 60, GROUP_SEND_BURST)
+
+    return bucket
+
+# Returns "sent", "retry" (timeouts and network errors) or "rejected" (the chat
+
+# will never take it: bot removed, chat not found, bad request).
+
+async def send_to_chat(chat_id, msg, keyboard):
+
+    bucket = chat_bucket(chat_id)
+
+    while True:
+
+        await bucket.acquire()
+
+        await GLOBAL_BUCKET.acquire()
+
+        try:
+
+            await bot.send_message(chat_id=chat_id, text=msg, parse_mode="HTML", reply_markup=keyboard)
+
+            SEND_STATS["sent"] += 1
+
+            return "sent"
+
+        except RetryAfter as e:
+
+            SEND_STATS["retry_after"] += 1
+
+            print(f"Flood Wait -> {chat_id}: {e.retry_after}s")
+
+            bucket.pause(e.retry_after)
+
+        except (Forbidden, BadRequest) as e:
+
+            SEND_STATS["rejected"] += 1
+
+            print(f"Send Rejected -> {chat_id}: {e} (dropped)")
+
+            return "rejected"
+
+        except NetworkError as e:
+
+            # Includes TimedOut; BadRequest is a NetworkError too, so it is caught above.
+
+            SEND_STATS["failed"] += 1
+
+            print(f"Send Error -> {chat_id}: {e}")
+
+            return "retry"
+
+        except Exception as e:
+
+            SEND_STATS["rejected"] += 1
+
+            print(f"Send Rejected -> {chat_id}: {e} (dropped)")
+
+            return "rejected"
+
+# ============================
+
+# DIGEST MODE
+
+# ============================
+
+DIGEST_MODE = False
+
+DIGEST_WINDOW = 3
+
+DIGEST_MAX_RECORDS = 10
+
+DIGEST_HEADER = "<b>📦 {count} new OTPs</b>\n\n"
+
+DIGEST_SEPARATOR = "\n\n"
+
+TELEGRAM_MAX_MESSAGE = 4096
+
+class DigestBuffer:
+
+    def __init__(self):
+
+        self.pending = {}
+
+        self.timers = {}
+
+        self.sending = set()
+
+        self.digests = 0
+
+        self.merged = 0
+
+    def add(self, chat_id, item, line, full_text):
+
+        batch = self.pending.get(chat_id)
+
+        if batch is not None and batch["size"] + len(line) + len(DIGEST_SEPARATOR) > TELEGRAM_MAX_MESSAGE:
+
+            self.flush(chat_id)
+
+            batch = None
+
+        if batch is None:
+
+            # Header length with room for a multi-digit count.
+
+            batch = self.pending[chat_id] = {"entries": [], "size": len(DIGEST_HEADER) + 4}
+
+            self.timers[chat_id] = asyncio.get_running_loop().call_later(DIGEST_WINDOW, self.flush, chat_id)
+
+        batch["entries"].append((item, line, full_text))
+
+        batch["size"] += len(line) + len(DIGEST_SEPARATOR)
+
+        if len(batch["entries"]) >= DIGEST_MAX_RECORDS:
+
+            self.flush(chat_id)
+
+    def flush(self, chat_id):
+
+        timer = self.timers.pop(chat_id, None)
+
+        if timer is not None:
+
+            timer.cancel()
+
+        batch = self.pending.pop(chat_id, None)
+
+        if batch:
+
+            task = asyncio.get_running_loop().create_task(self._send(chat_id, batch["entries"]))
+
+            self.sending.add(task)
+
+            task.add_done_callback(self.sending.discard)
+
+    async def _send(self, chat_id, entries):
+
+        if len(entries) == 1:
+
+            text = entries[0][2]
+
+        else:
+
+            text = DIGEST_HEADER.format(count=len(entries)) + DIGEST_SEPARATOR.join(line for _, line, _ in entries)
+
+            self.digests += 1
+
+            self.merged += len(entries)
+
+        result = await send_to_chat(chat_id, text, OTP_KEYBOARD_JSON)
+
+        if result == "retry":
+
+            for item, _, _ in entries:
+
+                retry_delivery(item, chat_id)
+
+            return
+
+        for item, _, _ in entries:
+
+            SPOOL.ack(item["id"], chat_id)
+
+        if result == "sent":
+
+            print(f"[DIGEST] Sent {len(entries)} records -> {chat_id}")
+
+    def stats(self):
+
+        return {
+
+            "digests": self.digests,
+
+            "merged": self.merged,
+
+            "pending_chats": len(self.pending)
+
+        }
+
+DIGESTS = DigestBuffer()
+
+async def deliver_item(item):
+
+    record = item["record"]
+
+    msgs = item.get("msgs") or {}
+
+    async def deliver(chat_id):
+
+        name = template_for(chat_id, record["service"])
+
+        text = msgs.get(name)
+
+        if text is None:
+
+            text = format_message(record, name)
+
+        if DIGEST_MODE:
+
+            line = msgs.get("digest")
+
+            if line is None:
+
+                line = format_message(record, "digest")
+
+            DIGESTS.add(chat_id, item, line, text)
+
+            return False
+
+        result = await send_to_chat(chat_id, text, OTP_KEYBOARD_JSON)
+
+        if result == "retry":
+
+            retry_delivery(item, chat_id)
+
+            return False
+
+        # A rejected chat is acked as well, or it would stay in the spool for good.
+
+        SPOOL.ack(item["id"], chat_id)
+
+        return result == "sent"
+
+    # True when at least one chat got the message right away (digests are sent later).
+
+    return any(await asyncio.gather(*(deliver(chat_id) for chat_id in item["chats"])))
+
+# A failed chat stays pending in the spool and is queued again after a jittered
+
+# exponential delay; past SEND_RETRY_LIMIT it waits for the next startup replay.
+
+SEND_RETRY_BASE_DELAY = 5
+
+SEND_RETRY_MAX_DELAY = 300
+
+SEND_RETRY_LIMIT = 8
+
+RETRY_TASKS = set()
+
+def retry_delivery(item, chat_id):
+
+    if chat_id not in ROUTER.groups:
+
+        print(f"Dropping {item['id']} -> {chat_id}: group no longer configured")
+
+        SPOOL.ack(item["id"], chat_id)
+
+        return
+
+    attempt = item.get("attempt", 0) + 1
+
+    if attempt > SEND_RETRY_LIMIT:
+
+        print(f"Giving up on {item['id']} -> {chat_id} until restart")
+
+        return
+
+    ceiling = min(SEND_RETRY_MAX_DELAY, SEND_RETRY_BASE_DELAY * 2 ** (attempt - 1))
+
+    delay = ceiling / 2 + random.uniform(0, ceiling / 2)
+
+    retry = dict(item, chats=[chat_id], attempt=attempt)
+
+    async def requeue():
+
+        await asyncio.sleep(delay)
+
+        await OUTBOX.put(retry, retry["priority"])
+
+    task = asyncio.get_running_loop().create_task(requeue())
+
+    RETRY_TASKS.add(task)
+
+    task.add_done_callback(RETRY_TASKS.discard)
+
+# ============================
+
+# OUTBOUND QUEUE
+
+# ============================
+
+OUTBOX_MAX_SIZE = 1000
+
+OUTBOX_POLICY = "block"
+
+OUTBOX_SENDERS = 4
+
+PRIORITY_HIGH = 0
+
+PRIORITY_LOW = 1
+
+class OutboundQueue:
+
+    def __init__(self, max_size, policy, on_drop=None):
+
+        self.max_size = max_size
+
+        self.policy = policy
+
+        self.on_drop = on_drop
+
+        self.items = deque()
+
+        self.cond = asyncio.Condition()
+
+        self.max_depth = 0
+
+        self.enqueued = 0
+
+        self.dequeued = 0
+
+        self.dropped = 0
+
+        self.wait_total = 0.0
+
+        self.wait_max = 0.0
+
+    def _drop_low_priority(self):
+
+        for i, entry in enumerate(self.items):
+
+            if entry[0] == PRIORITY_LOW:
+
+                del self.items[i]
+
+                return entry
+
+        return None
+
+    async def put(self, item, priority=PRIORITY_HIGH):
+
+        async with self.cond:
+
+            while len(self.items) >= self.max_size:
+
+                if self.policy == "drop_oldest":
+
+                    victim = self.items.popleft()
+
+                elif self.policy == "drop_low_priority":
+
+                    if priority == PRIORITY_LOW:
+
+                        self.dropped += 1
+
+                        if self.on_drop is not None:
+
+                            self.on_drop(item)
+
+                        return False
+
+                    victim = self._drop_low_priority()
+
+                    if victim is None:
+
+                        await self.cond.wait()
+
+                        continue
+
+                else:
+
+                    await self.cond.wait()
+
+                    continue
+
+                self.dropped += 1
+
+                print(f"[OUTBOX] Dropped queued message ({self.policy})")
+
+                if self.on_drop is not None:
+
+                    self.on_drop(victim[2])
+
+            self.items.append((priority, time.monotonic(), item))
+
+            self.enqueued += 1
+
+            self.max_depth = max(self.max_depth, len(self.items))
+
+            self.cond.notify_all()
+
+            return True
+
+    async def get(self):
+
+        async with self.cond:
+
+            while not self.items:
+
+                await self.cond.wait()
+
+            priority, enqueued_at, item = self.items.popleft()
+
+            waited = time.monotonic() - enqueued_at
+
+            self.dequeued += 1
+
+            self.wait_total += waited
+
+            self.wait_max = max(self.wait_max, waited)
+
+            self.cond.notify_all()
+
+            return item
+
+    def stats(self):
+
+        return {
+
+            "depth": len(self.items),
+
+            "max_depth": self.max_depth,
+
+            "enqueued": self.enqueued,
+
+            "dequeued": self.dequeued,
+
+            "dropped": self.dropped,
+
+            "wait_avg": self.wait_total / self.dequeued if self.dequeued else 0.0,
+
+            "wait_max": self.wait_max
+
+        }
+
+OUTBOX = OutboundQueue(OUTBOX_MAX_SIZE, OUTBOX_POLICY, on_drop=lambda item: SPOOL.discard(item["id"], item["chats"]))
+
+async def outbox_sender():
+
+    while True:
+
+        item = await OUTBOX.get()
+
+        try:
+
+            sent = await deliver_item(item)
+
+        except Exception as e:
+
+            print("Outbox Sender Error:", e)
+
+            continue
+
+        if sent:
+
+            record = item["record"]
+
+            print(f"[{item['panel'].upper()}] Sent: {record['service']} | {record['number']}")
+
+# ============================
+
+# OUTBOUND SPOOL
+
+# ============================
+
+SPOOL_FILE = "outbox.spool"
+
+SPOOL_COMMIT_DELAY = 0.02
+
+SPOOL_COMPACT_BYTES = 4 * 1024 * 1024
+
+class OutboundSpool:
+
+    def __init__(self, path):
+
+        self.path = path
+
+        self.file = None
+
+        self.pending = {}
+
+        self.buffer = []
+
+        self.writing = None
+
+        self.lock = threading.Lock()
+
+        self.buffered_seq = 0
+
+        self.committed_seq = 0
+
+        self.waiters = []
+
+        self.wakeup = asyncio.Event()
+
+        self.commits = 0
+
+        self.replayed = 0
+
+    def load(self):
+
+        pending = {}
+
+        if os.path.exists(self.path):
+
+            with open(self.path, "r", encoding="utf-8") as f:
+
+                for line in f:
+
+                    try:
+
+                        entry = json.loads(line)
+
+                    except ValueError:
+
+                        # A torn final line from a crash mid-write.
+
+                        break
+
+                    if entry.pop("op") == "put":
+
+                        pending.setdefault(entry["id"], entry)
+
+                        continue
+
+                    target = pending.get(entry["id"])
+
+                    if target is not None and entry["chat"] in target["chats"]:
+
+                        target["chats"].remove(entry["chat"])
+
+                        if not target["chats"]:
+
+                            del pending[entry["id"]]
+
+        self.pending = pending
+
+        self._rewrite(self._snapshot(), initial=True)
+
+        self.replayed = len(pending)
+
+        return [dict(entry, chats=list(entry["chats"])) for entry in pending.values()]
+
+    def _snapshot(self):
+
+        # Built on the event loop: add() and ack() keep changing pending while the rewrite runs.
+
+        return [json.dumps(dict(entry, op="put"), separators=(",", ":"), ensure_ascii=False) + "\n" for entry in self.pending.values()]
+
+    def _rewrite(self, lines, initial=False):
+
+        tmp = self.path + ".tmp"
+
+        with open(tmp, "w", encoding="utf-8") as f:
+
+            f.write("".join(lines))
+
+            f.flush()
+
+            os.fsync(f.fileno())
+
+        with self.lock:
+
+            if self.file is None and not initial:
+
+                # close() got in first; the old file already holds everything.
+
+                os.remove(tmp)
+
+                return
+
+            if self.file is not None:
+
+                self.file.close()
+
+            os.replace(tmp, self.path)
+
+            self.file = open(self.path, "a", encoding="utf-8")
+
+    def _write(self, lines):
+
+        with self.lock:
+
+            if self.file is None:
+
+                # close() got here first and wrote these lines itself.
+
+                return
+
+            self.file.write("".join(lines))
+
+            self.file.flush()
+
+            os.fsync(self.file.fileno())
+
+            if lines is self.writing:
+
+                self.writing = None
+
+    def _append(self, entry):
+
+        self.buffer.append(json.dumps(entry, separators=(",", ":"), ensure_ascii=False) + "\n")
+
+        self.buffered_seq += 1
+
+        self.wakeup.set()
+
+    def add(self, item):
+
+        if item["id"] in self.pending:
+
+            return False
+
+        self.pending[item["id"]] = dict(item, chats=list(item["chats"]))
+
+        self._append(dict(item, op="put"))
+
+        return True
+
+    def ack(self, item_id, chat_id):
+
+        entry = self.pending.get(item_id)
+
+        if entry is None or chat_id not in entry["chats"]:
+
+            return
+
+        entry["chats"].remove(chat_id)
+
+        if not entry["chats"]:
+
+            del self.pending[item_id]
+
+        self._append({"op": "ack", "id": item_id, "chat": chat_id})
+
+    def discard(self, item_id, chats):
+
+        # Only the chats this queue entry covered; a retry entry carries a single chat.
+
+        for chat_id in list(chats):
+
+            self.ack(item_id, chat_id)
+
+    async def commit(self):
+
+        target = self.buffered_seq
+
+        if self.committed_seq >= target:
+
+            return
+
+        waiter = asyncio.get_running_loop().create_future()
+
+        self.waiters.append((target, waiter))
+
+        await waiter
+
+    async def run(self):
+
+        while True:
+
+            await self.wakeup.wait()
+
+            # Give concurrent writers a moment to join this fsync.
+
+            await asyncio.sleep(SPOOL_COMMIT_DELAY)
+
+            self.wakeup.clear()
+
+            lines, self.buffer = self.buffer, []
+
+            seq = self.buffered_seq
+
+            self.writing = lines
+
+            try:
+
+                await asyncio.to_thread(self._write, lines)
+
+            except OSError as e:
+
+                print("Spool Write Error:", e)
+
+                self.writing = None
+
+                self.buffer[:0] = lines
+
+                self.wakeup.set()
+
+                await asyncio.sleep(1)
+
+                continue
+
+            self.commits += 1
+
+            self.committed_seq = seq
+
+            waiting = []
+
+            for target, waiter in self.waiters:
+
+                if target <= seq:
+
+                    if not waiter.done():
+
+                        waiter.set_result(None)
+
+                else:
+
+                    waiting.append((target, waiter))
+
+            self.waiters = waiting
+
+            if self.file.tell() >= SPOOL_COMPACT_BYTES:
+
+                try:
+
+                    await asyncio.to_thread(self._rewrite, self._snapshot())
+
+                except OSError as e:
+
+                    print("Spool Compaction Error:", e)
+
+    def close(self):
+
+        # Waits for a write still running in a thread after run() was cancelled.
+
+        with self.lock:
+
+            if self.file is None:
+
+                return
+
+            lines = (self.writing or []) + self.buffer
+
+            if lines:
+
+                self.file.write("".join(lines))
+
+                self.file.flush()
+
+                os.fsync(self.file.fileno())
+
+            self.writing = None
+
+            self.buffer = []
+
+            self.file.close()
+
+            self.file = None
+
+    def stats(self):
+
+        return {
+
+            "pending": len(self.pending),
+
+            "buffered": len(self.buffer),
+
+            "commits": self.commits,
+
+            "replayed": self.replayed
+
+        }
+
+SPOOL = OutboundSpool(SPOOL_FILE)
+
+def spool_item_id(panel, record):
+
+    return f"{panel}:{record_fingerprint(record)}"
+
+async def replay_spool(items):
+
+    # Groups removed from the config since the spool was written are acked, not replayed.
+
+    groups = set(ROUTER.groups)
+
+    replayed = 0
+
+    dropped = 0
+
+    for item in items:
+
+        gone = [chat_id for chat_id in item["chats"] if chat_id not in groups]
+
+        if gone:
+
+            SPOOL.discard(item["id"], gone)
+
+            dropped += len(gone)
+
+            item["chats"] = [chat_id for chat_id in item["chats"] if chat_id in groups]
+
+            if not item["chats"]:
+
+                continue
+
+        await OUTBOX.put(item, item["priority"])
+
+        replayed += 1
+
+    if replayed or dropped:
+
+        print(f"[SPOOL] Replayed {replayed} undelivered messages, dropped {dropped} deliveries to removed groups")
+
+# ============================
+
+# COMMAND HANDLER LOOP
+
+# ============================
+
+async def command_listener():
+
+    global UPDATE_OFFSET
+
+    while True:
+
+        try:
+
+            updates = await bot.get_updates(offset=UPDATE_OFFSET, timeout=10)
+
+            for update in updates:
+
+                UPDATE_OFFSET = update.update_id + 1
+
+                mark_state_dirty()
+
+                if update.message and update.message.text:
+
+                    text = update.message.text
+
+                    chat_id = update.message.chat_id
+
+                    if text.startswith("/start"):
+
+                        await bot.send_message(
+
+                            chat_id=chat_id,
+
+                            text="✅ Bot is working and active\nFor more details: @sex",
+
+                            reply_markup=START_KEYBOARD_JSON
+
+                        )
+
+                    elif text.startswith("/otpfor"):
+
+                        parts = text.split()
+
+                        if len(parts) < 2:
+
+                            await bot.send_message(chat_id=chat_id, text="Usage: /otpfor <number>")
+
+                            continue
+
+                        number = parts[1]
+
+                        stored = OTP_STORE.get(number)
+
+                        if stored is not None:
+
+                            await bot.send_message(
+
+                                chat_id=chat_id,
+
+                                text=f"🔐 OTP for {number}:\n<code>{stored}</code>",
+
+                                parse_mode="HTML"
+
+                            )
+
+                        else:
+
+                            found = False
+
+                            panels = list(API_PANELS)
+
+                            results = await asyncio.gather(*(fetch_records(panel) for panel in panels))
+
+                            for records in results:
+
+                                for data in reversed(records or []):
+
+                                    if number in data["number"]:
+
+                                        otp = extract_otp(data["message"], data["service"])
+
+                                        if otp:
+
+                                            OTP_STORE.put(number, otp, otp_ttl_for(data["service"]))
+
+                                            await bot.send_message(
+
+                                                chat_id=chat_id,
+
+                                                text=f"✅ OTP Found & Saved:\n<code>{otp}</code>",
+
+                                                parse_mode="HTML"
+
+                                            )
+
+                                            found = True
+
+                                            break
+
+                                if found:
+
+                                    break
+
+                            if not found:
+
+                                down = sum(1 for panel in panels if panel_breaker(panel).state == BREAKER_OPEN)
+
+                                note = f" ({down} panel(s) unavailable)" if down else ""
+
+                                await bot.send_message(chat_id=chat_id, text="❌ No OTP found for this number." + note)
+
+        except Exception as e:
+
+            print("Command Listener Error:", e)
+
+        await asyncio.sleep(1)
+
+# ============================
+
+# API WORKERS
+
+# ============================
+
+def format_record(record, otp, chats):
+
+    names = {template_for(chat_id, record["service"]) for chat_id in chats}
+
+    if DIGEST_MODE:
+
+        names.add("digest")
+
+    if "first_record" in STARTUP_TIMINGS:
+
+        return render_messages(record, otp, names)
+
+    started = time.perf_counter()
+
+    msgs = render_messages(record, otp, names)
+
+    now = time.perf_counter()
+
+    STARTUP_TIMINGS["first_record_format"] = now - started
+
+    STARTUP_TIMINGS["first_record"] = now - STARTED_AT
+
+    print("[STARTUP]", startup_report())
+
+    return msgs
+
+# The CPU-heavy half of handling a record; in sharded mode it runs in the shard
+
+# process and the entry is pickled over to the sender.
+
+def prepare_record(panel, data):
+
+    otp = extract_otp(data["message"], data["service"])
+
+    chats = ROUTER.route(panel, data)
+
+    return {
+
+        "id": spool_item_id(panel, data),
+
+        "key": dedup_key(panel, data),
+
+        "panel": panel,
+
+        "record": data,
+
+        "otp": otp,
+
+        "ttl": otp_ttl_for(data["service"]),
+
+        "msgs": format_record(data, otp, chats) if chats else {},
+
+        "priority": PRIORITY_HIGH if otp else PRIORITY_LOW,
+
+        "chats": chats
+
+    }
+
+async def accept_records(entries):
+
+    batch = []
+
+    keys = set()
+
+    for entry in entries:
+
+        key = entry.pop("key")
+
+        if key in keys or DEDUP.seen(key):
+
+            continue
+
+        keys.add(key)
+
+        otp = entry.pop("otp")
+
+        ttl = entry.pop("ttl")
+
+        if otp:
+
+            OTP_STORE.put(entry["record"]["number"], otp, ttl)
+
+        if entry["chats"] and SPOOL.add(entry):
+
+            batch.append(entry)
+
+    if batch:
+
+        await SPOOL.commit()
+
+    # Recorded only once the spool is durable, so state_flusher can't persist
+
+    # a fingerprint for a record that a crash would lose.
+
+    for key in keys:
+
+        DEDUP.add(key)
+
+    for item in batch:
+
+        await OUTBOX.put(item, item["priority"])
+
+POLL_INTERVAL = 3
+
+POLL_MIN_INTERVAL = 1
+
+POLL_MAX_INTERVAL = 30
+
+# OTPs go stale fast: while a panel is active no code waits longer than this to be
+
+# picked up. Only after POLL_IDLE_AFTER seconds without a record may it back off
+
+# towards POLL_MAX_INTERVAL.
+
+POLL_MAX_STALENESS = 3
+
+POLL_IDLE_AFTER = 300
+
+POLL_BACKOFF = 1.5
+
+POLL_EWMA_ALPHA = 0.3
+
+POLL_TARGET_FILL = 0.5
+
+class PollScheduler:
+
+    def __init__(self, interval=None, min_interval=None, max_interval=None, max_staleness=None):
+
+        self.retune(interval, min_interval, max_interval, max_staleness)
+
+        self.rate = None
+
+        self.page_size = 0
+
+        self.last_poll = None
+
+        self.last_record = time.monotonic()
+
+        self.overflows = 0
+
+    def retune(self, interval=None, min_interval=None, max_interval=None, max_staleness=None):
+
+        self.min_interval = POLL_MIN_INTERVAL if min_interval is None else min_interval
+
+        self.max_interval = POLL_MAX_INTERVAL if max_interval is None else max_interval
+
+        self.max_staleness = POLL_MAX_STALENESS if max_staleness is None else max_staleness
+
+        current = getattr(self, "interval", POLL_INTERVAL)
+
+        self.interval = min(max(current if interval is None else interval, self.min_interval), self.max_interval)
+
+    def observe(self, new_records, page_size, overflow):
+
+        now = time.monotonic()
+
+        last, self.last_poll = self.last_poll, now
+
+        self.page_size = page_size
+
+        if new_records:
+
+            self.last_record = now
+
+        if last is None:
+
+            return
+
+        sample = new_records / max(now - last, 1e-3)
+
+        self.rate = sample if self.rate is None else POLL_EWMA_ALPHA * sample + (1 - POLL_EWMA_ALPHA) * self.rate
+
+        if overflow:
+
+            # The whole page was new, so records may have slipped past; poll as fast as allowed.
+
+            self.overflows += 1
+
+            self.interval = self.min_interval
+
+            return
+
+        target = POLL_TARGET_FILL * page_size / self.rate if self.rate > 0 else self.max_interval
+
+        ceiling = self.max_interval if self.idle(now) else min(self.max_staleness, self.max_interval)
+
+        # Speed up at once, slow down gradually.
+
+        self.interval = max(self.min_interval, min(target, self.interval * POLL_BACKOFF, ceiling))
+
+    def idle(self, now=None):
+
+        return (time.monotonic() if now is None else now) - self.last_record >= POLL_IDLE_AFTER
+
+    def miss_probability(self):
+
+        # P(more than a page of arrivals between polls), arrivals ~ Poisson(rate * interval).
+
+        if not self.rate or not self.page_size:
+
+            return 0.0
+
+        lam = self.rate * self.interval
+
+        term = math.exp(-lam)
+
+        cumulative = term
+
+        for k in range(1, self.page_size + 1):
+
+            term *= lam / k
+
+            cumulative += term
+
+        return max(0.0, 1.0 - cumulative)
+
+    def stats(self):
+
+        return {
+
+            "interval": round(self.interval, 2),
+
+            "rate": round(self.rate or 0.0, 4),
+
+            "idle": self.idle(),
+
+            "miss_probability": round(self.miss_probability(), 6),
+
+            "overflows": self.overflows
+
+        }
+
+POLL_SCHEDULERS = {}
+
+PAGE_MIN_RECORDS = 10
+
+PAGE_MAX_RECORDS = 200
+
+PAGE_SHRINK_OVERLAP = 0.8
+
+PAGE_SHRINK_AFTER = 10
+
+class PageSizer:
+
+    def __init__(self, panel, size):
+
+        self.panel = panel
+
+        self.size = size
+
+        self.calm_polls = 0
+
+        self.gaps = 0
+
+    def observe(self, fetched, fresh):
+
+        overlap = fetched - fresh
+
+        if fetched >= self.size and overlap == 0:
+
+            self.gaps += 1
+
+            self.calm_polls = 0
+
+            grown = min(self.size * 2, PAGE_MAX_RECORDS)
+
+            print(f"[{self.panel.upper()}] Possible gap: all {fetched} fetched records were new (records {self.size} -> {grown})")
+
+            self.size = grown
+
+        elif overlap >= PAGE_SHRINK_OVERLAP * fetched:
+
+            self.calm_polls += 1
+
+            if self.calm_polls >= PAGE_SHRINK_AFTER and self.size > PAGE_MIN_RECORDS:
+
+                self.size = max(PAGE_MIN_RECORDS, self.size * 3 // 4)
+
+                self.calm_polls = 0
+
+        else:
+
+            self.calm_polls = 0
+
+    def stats(self):
+
+        return {
+
+            "records": self.size,
+
+            "gaps": self.gaps
+
+        }
+
+PAGE_SIZERS = {}
+
+async def api_worker(panel, stop, delay=0):
+
+    if delay:
+
+        try:
+
+            await asyncio.wait_for(stop.wait(), delay)
+
+        except asyncio.TimeoutError:
+
+            pass
+
+    if stop.is_set():
+
+        return
+
+    print(f"[STARTED] {panel.upper()} Worker")
+
+    scheduler = POLL_SCHEDULERS[panel] = PollScheduler(**API_PANELS[panel].get("poll", {}))
+
+    sizer = PAGE_SIZERS[panel] = PageSizer(panel, API_PANELS[panel]["records"])
+
+    try:
+
+        await poll_panel(panel, stop, scheduler, sizer)
+
+    finally:
+
+        # A replacement worker for the same panel may already have registered its own.
+
+        if POLL_SCHEDULERS.get(panel) is scheduler:
+
+            del POLL_SCHEDULERS[panel]
+
+        if PAGE_SIZERS.get(panel) is sizer:
+
+            del PAGE_SIZERS[panel]
+
+        if panel not in PANEL_WORKERS:
+
+            PANEL_BREAKERS.pop(panel, None)
+
+            PANEL_LATENCY.pop(panel, None)
+
+    print(f"[STOPPED] {panel.upper()} Worker")
+
+async def poll_panel(panel, stop, scheduler, sizer):
+
+    while not stop.is_set():
+
+        page_size = sizer.size
+
+        records = await fetch_records(panel)
+
+        had_cursor = panel in PANEL_CURSORS
+
+        fresh, cursor = take_new_records(panel, records)
+
+        if records is not None:
+
+            scheduler.observe(len(fresh), page_size, had_cursor and len(fresh) >= page_size)
+
+            if had_cursor:
+
+                sizer.observe(len(records), len(fresh))
+
+        entries = [prepare_record(panel, data) for data in fresh if cli_passes_filter(data["service"])]
+
+        if PROCESS_ROLE == "shard":
+
+            if cursor is not None:
+
+                PANEL_CURSORS[panel] = cursor
+
+            if records:
+
+                await send_to_sender(("batch", panel, entries, PANEL_CURSORS.get(panel)))
+
+        else:
+
+            await accept_records(entries)
+
+            if cursor is not None:
+
+                PANEL_CURSORS[panel] = cursor
+
+                mark_state_dirty()
+
+        # Removing the panel from the config wakes this up; a batch in progress always finishes.
+
+        try:
+
+            await asyncio.wait_for(stop.wait(), max(scheduler.interval, panel_breaker(panel).remaining()))
+
+        except asyncio.TimeoutError:
+
+            pass
+
+# ============================
+
+# CONFIG REGISTRY
+
+# ============================
+
+CONFIG_FILE = "bot_config.json"
+
+CONFIG_RELOAD_INTERVAL = 10
+
+PANEL_START_SPREAD = 5
+
+# Every key in CONFIG_FILE is optional and replaces the built-in setting above;
+
+# deleting a key (or the file) goes back to it. bot_token is only read at startup.
+
+# {
+
+#   "bot_token": "...",
+
+#   "groups": [-100123],
+
+#   "panels": {"cr": {"url": "...", "token": "...", "records": 20, "timeout": 10,
+
+#              "fields": {"number": "phone"}, "poll": {"interval": 3, "min_interval": 1, "max_interval": 30}}},
+
+#   "cli_filter": {"mode": "allow", "allowed": ["whatsapp"], "blocked": []},
+
+#   "routes": {"-100123": {"services": ["whatsapp"]}},
+
+#   "templates": {"short": "{service} {otp}"},
+
+#   "group_templates": {"-100123": "compact"},
+
+#   "service_templates": {"telegram": "compact"}
+
+# }
+
+DEFAULT_CONFIG = {
+
+    "bot_token": BOT_TOKEN,
+
+    "groups": list(GROUP_IDS),
+
+    "panels": {name: dict(cfg) for name, cfg in API_PANELS.items()},
+
+    "cli_filter": {"mode": CLI_FILTER_MODE, "allowed": list(ALLOWED_CLIS), "blocked": list(BLOCKED_CLIS)},
+
+    "routes": dict(GROUP_ROUTES),
+
+    "templates": {},
+
+    "group_templates": dict(GROUP_TEMPLATES),
+
+    "service_templates": dict(SERVICE_TEMPLATES)
+
+}
+
+BUILTIN_TEMPLATES = dict(MESSAGE_TEMPLATES)
+
+POLL_SETTINGS = {"interval", "min_interval", "max_interval", "max_staleness"}
+
+CONFIG_MTIME = None
+
+CONFIG_APPLIED = {}
+
+CONFIG_STATS = {"loads": 0, "errors": 0, "panels_added": 0, "panels_removed": 0, "panels_retuned": 0}
+
+PANEL_WORKERS = {}
+
+def panel_config(name, cfg):
+
+    if not isinstance(cfg, dict) or not cfg.get("url") or "token" not in cfg:
+
+        raise ValueError(f"panel {name} needs a url and a token")
+
+    fields = dict(RECORD_FIELDS, **cfg.get("fields", {}))
+
+    if set(fields) != set(RECORD_FIELDS):
+
+        raise ValueError(f"panel {name} maps unknown fields: {', '.join(sorted(set(fields) - set(RECORD_FIELDS)))}")
+
+    poll = {key: float(value) for key, value in cfg.get("poll", {}).items()}
+
+    if set(poll) - POLL_SETTINGS:
+
+        raise ValueError(f"panel {name} has unknown poll settings: {', '.join(sorted(set(poll) - POLL_SETTINGS))}")
+
+    return {
+
+        "url": cfg["url"],
+
+        "token": cfg["token"],
+
+        "records": int(cfg.get("records", 20)),
+
+        "timeout": float(cfg.get("timeout", PANEL_TIMEOUT)),
+
+        "fields": fields,
+
+        "poll": poll
+
+    }
+
+def chat_keyed(table):
+
+    return {int(chat_id): value for chat_id, value in table.items()}
+
+def start_panel_worker(panel, delay=0):
+
+    stop = asyncio.Event()
+
+    task = asyncio.ensure_future(api_worker(panel, stop, delay))
+
+    task.add_done_callback(panel_worker_done)
+
+    PANEL_WORKERS[panel] = (task, stop)
+
+def panel_worker_done(task):
+
+    if not task.cancelled() and task.exception() is not None:
+
+        print("Panel Worker Error:", repr(task.exception()))
+
+def stop_panel_worker(panel):
+
+    task, stop = PANEL_WORKERS.pop(panel)
+
+    stop.set()
+
+def retune_panel(panel, old, cfg):
+
+    if cfg["url"] != old["url"] or cfg["fields"] != old["fields"]:
+
+        # A different feed: the old cursor and health history no longer apply.
+
+        PANEL_CURSORS.pop(panel, None)
+
+        PANEL_BREAKERS.pop(panel, None)
+
+        PANEL_LATENCY.pop(panel, None)
+
+    sizer = PAGE_SIZERS.get(panel)
+
+    if sizer is not None and cfg["records"] != old["records"]:
+
+        sizer.size = cfg["records"]
+
+    scheduler = POLL_SCHEDULERS.get(panel)
+
+    if scheduler is not None and cfg["poll"] != old["poll"]:
+
+        scheduler.retune(**cfg["poll"])
+
+def sync_panels(panels, startup=False):
+
+    for panel in [name for name in API_PANELS if name not in panels]:
+
+        del API_PANELS[panel]
+
+        if panel in PANEL_WORKERS:
+
+            stop_panel_worker(panel)
+
+            CONFIG_STATS["panels_removed"] += 1
+
+            print(f"[CONFIG] Removed panel {panel}")
+
+    added = [name for name in panels if name not in PANEL_WORKERS and owns_panel(name)]
+
+    for panel, cfg in panels.items():
+
+        old = API_PANELS.get(panel)
+
+        API_PANELS[panel] = cfg
+
+        if panel in PANEL_WORKERS and old != cfg:
+
+            retune_panel(panel, old, cfg)
+
+            CONFIG_STATS["panels_retuned"] += 1
+
+            print(f"[CONFIG] Retuned panel {panel}")
+
+    for i, panel in enumerate(added):
+
+        # Spread the first polls of a large registry instead of firing them all at once.
+
+        start_panel_worker(panel, PANEL_START_SPREAD * i / len(added) if startup else 0)
+
+        if not startup:
+
+            CONFIG_STATS["panels_added"] += 1
+
+            print(f"[CONFIG] Added panel {panel}")
+
+    hosts = {panel_host(cfg["url"]) for cfg in API_PANELS.values()}
+
+    for host in [host for host in PANEL_CLIENTS if host not in hosts]:
+
+        asyncio.ensure_future(PANEL_CLIENTS.pop(host).aclose())
+
+def apply_config(config, startup=False):
+
+    global BOT_TOKEN, bot, GROUP_IDS, GROUP_ROUTES, ROUTER, GROUP_TEMPLATES, SERVICE_TEMPLATES
+
+    global CLI_FILTER_MODE, ALLOWED_CLIS, BLOCKED_CLIS, CLI_FILTER, MESSAGE_TEMPLATES, COMPILED_TEMPLATES
+
+    # Build everything into locals first so a bad file leaves the running config untouched.
+
+    panels = {str(name): panel_config(name, cfg) for name, cfg in config["panels"].items()}
+
+    groups = [int(chat_id) for chat_id in config["groups"]]
+
+    routes = chat_keyed(config["routes"])
+
+    cli_filter = dict(DEFAULT_CONFIG["cli_filter"], **config["cli_filter"])
+
+    if cli_filter["mode"] not in ("off", "allow", "block"):
+
+        raise ValueError(f"unknown cli_filter mode: {cli_filter['mode']}")
+
+    templates = dict(BUILTIN_TEMPLATES, **config["templates"])
+
+    group_templates = chat_keyed(config["group_templates"])
+
+    service_templates = {normalize_cli(service): name for service, name in config["service_templates"].items()}
+
+    new_bot = None
+
+    if startup and config["bot_token"] != BOT_TOKEN:
+
+        new_bot = Bot(token=config["bot_token"])
+
+    elif config["bot_token"] != BOT_TOKEN:
+
+        print("[CONFIG] bot_token changed; it takes effect after a restart")
+
+    router = None
+
+    if (groups, routes) != (CONFIG_APPLIED.get("groups"), CONFIG_APPLIED.get("routes")):
+
+        router = RoutingIndex(groups, routes)
+
+    cli = None
+
+    if cli_filter != CONFIG_APPLIED.get("cli_filter"):
+
+        allowed, blocked = list(cli_filter["allowed"]), list(cli_filter["blocked"])
+
+        cli = CliFilter(cli_filter["mode"], allowed, blocked)
+
+    compiled = None
+
+    if templates != CONFIG_APPLIED.get("templates"):
+
+        compiled = build_templates(templates)
+
+    # Everything built; swap it all in together.
+
+    if new_bot is not None:
+
+        BOT_TOKEN, bot = config["bot_token"], new_bot
+
+    if router is not None:
+
+        GROUP_IDS, GROUP_ROUTES, ROUTER = groups, routes, router
+
+    if cli is not None:
+
+        CLI_FILTER_MODE, ALLOWED_CLIS, BLOCKED_CLIS, CLI_FILTER = cli_filter["mode"], allowed, blocked, cli
+
+    if compiled is not None:
+
+        MESSAGE_TEMPLATES, COMPILED_TEMPLATES = templates, compiled
+
+    GROUP_TEMPLATES = group_templates
+
+    SERVICE_TEMPLATES = service_templates
+
+    sync_panels(panels, startup)
+
+    CONFIG_APPLIED.update(groups=groups, routes=routes, cli_filter=cli_filter, templates=templates)
+
+def load_config(startup=False):
+
+    global CONFIG_MTIME
+
+    try:
+
+        mtime = os.stat(CONFIG_FILE).st_mtime
+
+    except OSError:
+
+        mtime = None
+
+    if mtime == CONFIG_MTIME and not startup:
+
+        return
+
+    CONFIG_MTIME = mtime
+
+    overrides = {}
+
+    if mtime is not None:
+
+        try:
+
+            with open(CONFIG_FILE, "r", encoding="utf-8") as f:
+
+                overrides = json.load(f)
+
+            if not isinstance(overrides, dict):
+
+                raise ValueError("top level must be an object")
+
+        except (OSError, ValueError) as e:
+
+            CONFIG_STATS["errors"] += 1
+
+            print("Config Load Error:", e)
+
+            if not startup:
+
+                return
+
+            overrides = {}
+
+    unknown = set(overrides) - set(DEFAULT_CONFIG)
+
+    if unknown:
+
+        print(f"[CONFIG] Ignoring unknown keys: {', '.join(sorted(unknown))}")
+
+    config = dict(DEFAULT_CONFIG, **{key: value for key, value in overrides.items() if key in DEFAULT_CONFIG})
+
+    try:
+
+        apply_config(config, startup)
+
+    except (AttributeError, KeyError, TypeError, ValueError) as e:
+
+        CONFIG_STATS["errors"] += 1
+
+        print("Config Error:", e)
+
+        if startup:
+
+            print("[CONFIG] Starting with the built-in settings")
+
+            apply_config(DEFAULT_CONFIG, startup)
+
+        return
+
+    CONFIG_STATS["loads"] += 1
+
+    source = CONFIG_FILE if mtime is not None else "built-in settings"
+
+    print(f"[CONFIG] Loaded {source}: {len(API_PANELS)} panels, {len(GROUP_IDS)} groups")
+
+async def config_watcher():
+
+    while True:
+
+        await asyncio.sleep(CONFIG_RELOAD_INTERVAL)
+
+        load_config()
+
+# ============================
+
+# PANEL SHARDS
+
+# ============================
+
+# With --shards N the panels are split across N shard processes that poll,
+
+# extract and render. This process becomes the sender: it owns Telegram, the
+
+# rate limits, the spool, the OTP store, dedup and the state file, and only
+
+# receives ready-to-send batches over a pipe.
+
+PANEL_SHARDS = 1
+
+SHARD_RESTART_DELAY = 5
+
+SHARD_STATS_INTERVAL = 60
+
+SHARD_SEND_QUEUE_SIZE = 64
+
+PROCESS_ROLE = "single"
+
+SHARD_INDEX = 0
+
+SHARD_COUNT = 1
+
+SHARD_CONN = None
+
+SHARD_OUTBOX = None
+
+SHARD_STATS = {}
+
+def shard_of(panel, count):
+
+    return int(hashlib.sha1(panel.encode()).hexdigest()[:8], 16) % count
+
+def owns_panel(panel):
+
+    if PROCESS_ROLE == "sender":
+
+        return False
+
+    if PROCESS_ROLE == "shard":
+
+        return shard_of(panel, SHARD_COUNT) == SHARD_INDEX
+
+    return True
+
+async def send_to_sender(message):
+
+    # Only the producing worker waits when the sender falls behind; the
+
+    # shard's event loop (and its other panels) keep running.
+
+    await SHARD_OUTBOX.put(message)
+
+async def shard_writer():
+
+    while True:
+
+        message = await SHARD_OUTBOX.get()
+
+        await asyncio.to_thread(SHARD_CONN.send, message)
+
+def shard_stats():
+
+    return {
+
+        "panels": sorted(PANEL_WORKERS),
+
+        "cli_filter": CLI_FILTER.stats(),
+
+        "routing": ROUTER.stats(),
+
+        "otp_rules": OTP_RULES.stats(),
+
+        "enrich_cache": cache_stats(enrich_number),
+
+        "startup_ms": {name: round(seconds * 1000, 1) for name, seconds in STARTUP_TIMINGS.items()},
+
+        "polling": {panel: scheduler.stats() for panel, scheduler in POLL_SCHEDULERS.items()},
+
+        "page_sizes": {panel: sizer.stats() for panel, sizer in PAGE_SIZERS.items()},
+
+        "breakers": {panel: breaker.stats() for panel, breaker in PANEL_BREAKERS.items()},
+
+        "latency": {panel: histogram.stats() for panel, histogram in PANEL_LATENCY.items()},
+
+        "hedging": HEDGE_BUDGET.stats()
+
+    }
+
+async def shard_stats_reporter():
+
+    while True:
+
+        await asyncio.sleep(SHARD_STATS_INTERVAL)
+
+        await send_to_sender(("stats", SHARD_INDEX, shard_stats()))
+
+async def shard_loop():
+
+    global SHARD_OUTBOX
+
+    SHARD_OUTBOX = asyncio.Queue(SHARD_SEND_QUEUE_SIZE)
+
+    try:
+
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+
+    except NotImplementedError:
+
+        pass
+
+    load_otp_rules()
+
+    load_config(startup=True)
+
+    tasks = [shard_writer(), otp_rules_watcher(), config_watcher(), shard_stats_reporter()]
+
+    if ENRICHMENT_WARM_UP:
+
+        tasks.append(warm_up_enrichment())
+
+    try:
+
+        await asyncio.gather(*tasks)
+
+    finally:
+
+        for task, stop in PANEL_WORKERS.values():
+
+            task.cancel()
+
+        await close_panel_clients()
+
+def shard_main(index, count, conn, cursors):
+
+    global PROCESS_ROLE, SHARD_INDEX, SHARD_COUNT, SHARD_CONN
+
+    # Ctrl+C reaches the whole process group; the sender decides when shards stop.
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    PROCESS_ROLE = "shard"
+
+    SHARD_INDEX = index
+
+    SHARD_COUNT = count
+
+    SHARD_CONN = conn
+
+    PANEL_CURSORS.update(cursors)
+
+    try:
+
+        asyncio.run(shard_loop())
+
+    except (asyncio.CancelledError, BrokenPipeError):
+
+        pass
+
+async def handle_shard_message(message):
+
+    if message[0] == "batch":
+
+        _, panel, entries, cursor = message
+
+        await accept_records(entries)
+
+        # Only after the batch is in the spool, like poll_panel() does.
+
+        if cursor is not None:
+
+            PANEL_CURSORS[panel] = cursor
+
+            mark_state_dirty()
+
+    elif message[0] == "stats":
+
+        _, index, stats = message
+
+        SHARD_STATS[index] = stats
+
+async def run_shard(index, count, executor):
+
+    loop = asyncio.get_running_loop()
+
+    # spawn, not fork: this process already has an event loop and OTP store threads.
+
+    ctx = multiprocessing.get_context("spawn")
+
+    while True:
+
+        receiver, sender = ctx.Pipe(duplex=False)
+
+        cursors = {panel: cursor for panel, cursor in PANEL_CURSORS.items() if shard_of(panel, count) == index}
+
+        process = ctx.Process(target=shard_main, args=(index, count, sender, cursors), name=f"shard-{index}", daemon=True)
+
+        process.start()
+
+        sender.close()
+
+        print(f"[SHARD {index}] Started pid {process.pid}")
+
+        try:
+
+            while True:
+
+                try:
+
+                    message = await loop.run_in_executor(executor, receiver.recv)
+
+                except EOFError:
+
+                    break
+
+                await handle_shard_message(message)
+
+        finally:
+
+            if process.is_alive():
+
+                process.terminate()
+
+            await loop.run_in_executor(None, process.join)
+
+            receiver.close()
+
+        print(f"[SHARD {index}] Exited with code {process.exitcode}, restarting in {SHARD_RESTART_DELAY}s")
+
+        await asyncio.sleep(SHARD_RESTART_DELAY)
+
+# ============================
+
+# METRICS
+
+# ============================
+
+METRICS_INTERVAL = 300
+
+def collect_metrics():
+
+    return {
+
+        "dedup": DEDUP.stats(),
+
+        "cli_filter": CLI_FILTER.stats(),
+
+        "routing": ROUTER.stats(),
+
+        "otp_rules": OTP_RULES.stats(),
+
+        "country_cache": cache_stats(parse_country_info),
+
+        "enrich_cache": cache_stats(enrich_number),
+
+        "startup_ms": {name: round(seconds * 1000, 1) for name, seconds in STARTUP_TIMINGS.items()},
+
+        "otp_store": OTP_STORE.stats(),
+
+        "send": dict(SEND_STATS, chats=len(CHAT_BUCKETS), retrying=len(RETRY_TASKS)),
+
+        "outbox": OUTBOX.stats(),
+
+        "spool": SPOOL.stats(),
+
+        "digest": DIGESTS.stats(),
+
+        "polling": {panel: scheduler.stats() for panel, scheduler in POLL_SCHEDULERS.items()},
+
+        "page_sizes": {panel: sizer.stats() for panel, sizer in PAGE_SIZERS.items()},
+
+        "breakers": {panel: breaker.stats() for panel, breaker in PANEL_BREAKERS.items()},
+
+        "latency": {panel: histogram.stats() for panel, histogram in PANEL_LATENCY.items()},
+
+        "hedging": dict(HEDGE_BUDGET.stats(), enabled=HEDGE_ENABLED),
+
+        "config": dict(CONFIG_STATS, panels=len(API_PANELS), workers=len(PANEL_WORKERS)),
+
+        "shards": SHARD_STATS
+
+    }
+
+async def metrics_reporter():
+
+    while True:
+
+        await asyncio.sleep(METRICS_INTERVAL)
+
+        print("[METRICS]", json.dumps(collect_metrics()))
+
+# ============================
+
+# MAIN
+
+# ============================
+
+async def main(shards=PANEL_SHARDS):
+
+    global PROCESS_ROLE
+
+    if shards > 1:
+
+        PROCESS_ROLE = "sender"
+
+    load_state()
+
+    OTP_STORE.open()
+
+    load_otp_rules()
+
+    spooled = SPOOL.load()
+
+    try:
+
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+
+    except NotImplementedError:
+
+        pass
+
+    load_config(startup=True)
+
+    tasks = [SPOOL.run()]
+
+    tasks.append(replay_spool(spooled))
+
+    tasks.extend(outbox_sender() for _ in range(OUTBOX_SENDERS))
+
+    tasks.append(command_listener())
+
+    tasks.append(otp_rules_watcher())
+
+    tasks.append(config_watcher())
+
+    if ENRICHMENT_WARM_UP:
+
+        tasks.append(warm_up_enrichment())
+
+    tasks.append(metrics_reporter())
+
+    tasks.append(state_flusher())
+
+    tasks.append(otp_store_flusher())
+
+    tasks.append(otp_store_compactor())
+
+    receivers = None
+
+    if shards > 1:
+
+        receivers = concurrent.futures.ThreadPoolExecutor(max_workers=shards, thread_name_prefix="shard-recv")
+
+        tasks.extend(run_shard(index, shards, receivers) for index in range(shards))
+
+    try:
+
+        await asyncio.gather(*tasks)
+
+    finally:
+
+        if receivers is not None:
+
+            receivers.shutdown(wait=False)
+
+        for task, stop in PANEL_WORKERS.values():
+
+            task.cancel()
+
+        await close_panel_clients()
+
+        await flush_state()
+
+        OTP_STORE.close()
+
+        SPOOL.close()
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--bench-otp", metavar="CORPUS", nargs="?", const=OTP_CORPUS_FILE, help=f"benchmark OTP extraction on a file of SMS texts (default {OTP_CORPUS_FILE})")
+
+    parser.add_argument("--shards", type=int, default=PANEL_SHARDS, help="poll panels in this many worker processes")
+
+    args = parser.parse_args()
+
+    if args.bench_otp:
+
+        bench_extract_otp(args.bench_otp)
+
+    else:
+
+        try:
+
+            asyncio.run(main(args.shards))
+
+        except asyncio.CancelledError:
+
+            # SIGTERM cancels main(); shutdown already ran in its finally block.
 
-    asyncio.run(main())
\ No newline at end of file
+            pass
\ No newline at end of file